@@ -0,0 +1,73 @@
+"""
+accumulators.py - mergeable running statistics
+
+constant-time, constant-memory accumulators shared by the simulators and the
+live statistics engine, plus the true count bucketing they are keyed by.
+"""
+
+import math
+
+#
+#   Constants
+#
+
+TC_MIN = -10
+TC_MAX = 10
+
+
+def tc_bucket(tc):
+    """
+    rounds a true count to its bucket (halves away from minus infinity, as the
+    ledger's lua does), clamped to [TC_MIN, TC_MAX].
+    """
+
+    return min(TC_MAX, max(TC_MIN, math.floor(tc + 0.5)))
+
+
+class Accumulator:
+    """
+    welford running mean and variance, mergeable with chan's parallel update.
+    """
+
+    __slots__ = ("n", "mean", "m2")
+
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        n = self.n + other.n
+
+        if not n:
+            return self
+
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def total(self):
+        return self.mean * self.n
+
+    def __getstate__(self):
+        return self.n, self.mean, self.m2
+
+    def __setstate__(self, state):
+        self.n, self.mean, self.m2 = state
+
+    def as_list(self):
+        return [self.n, self.mean, self.m2]
@@ -18,9 +18,17 @@ from enum import Enum
 import redis
 from loguru import logger
 
+try:
+    from redis.utils import HIREDIS_AVAILABLE
+except ImportError:
+    HIREDIS_AVAILABLE = False
+
+# shared connection pools, keyed by config
+_pools = {}
+
 
 class SCHEMA:
-    STATUS = "status"
+    STATUS = "sys:status"
 
 
 class Status(Enum):
@@ -38,9 +46,33 @@ class Status(Enum):
     WAITING = 7
 
 
+def connection_pool(config):
+    """
+    returns the connection pool shared by every client with the same config,
+    creating it on first use. no connection is opened until a command is sent.
+
+    the hiredis parser is used automatically whenever it is installed.
+    """
+
+    key = tuple(sorted(config.items()))
+
+    if key not in _pools:
+        logger.info(f"creating redis connection pool (hiredis: {HIREDIS_AVAILABLE})")
+        _pools[key] = redis.ConnectionPool(
+            encoding="utf-8",
+            decode_responses=True,
+            **config
+        )
+
+    return _pools[key]
+
+
 class DatabaseIface:
     """
     the asrm database interface (redis)
+
+    clients share a connection pool per config and connect lazily, so creating
+    an interface is free.
     """
 
     CHANNEL = 'rainman'
@@ -48,39 +80,37 @@ class DatabaseIface:
     _redis_default_config = {
         # Redis configuration
         "host": "127.0.0.1",
-        "port": "6379",
+        "port": 6379,
         "db": 0,
+        # Connection tuning
+        # no read timeout, so blocking reads (pubsub, XREAD BLOCK) can idle;
+        # keepalive detects dead peers instead
+        "socket_keepalive": True,
+        "socket_timeout": None,
+        "socket_connect_timeout": 5.0,
+        "health_check_interval": 30,
+        "max_connections": None,
     }
 
     def __init__(self, config=None, clear=False):
-        logger.info(f"creating redis database interface")
-        if config is None:
-            config = {}
-
-        self._db = redis.StrictRedis(
-            charset="utf-8",
-            decode_responses=True,
-            **config
-        )
+        self.config = dict(self._redis_default_config, **(config or {}))
+        self._db = None
 
         if clear is True:
             logger.warning("clear is True, which will flush the database upon instantiation")
             self.clear_session(flushall=True)
 
-        self.config = self._redis_default_config
-        self.connect(self.config)
-
     @property
     def db(self):
+        if self._db is None:
+            self.connect()
+
         return self._db
 
     @db.setter
     def db(self, config):
-        self._db = redis.StrictRedis(
-            **config,
-            charset="utf-8",
-            decode_responses=True,
-        )
+        self.config = dict(self._redis_default_config, **config)
+        self._db = redis.StrictRedis(connection_pool=connection_pool(self.config))
 
     def connect(self, config=None):
         """
@@ -90,9 +120,10 @@ class DatabaseIface:
         if config is None:
             config = self.config
 
+        logger.info(f"creating redis database interface")
         self.db = config
 
-        return self.db
+        return self._db
 
     def clear_session(self, flushall=False):
         """
@@ -121,11 +152,8 @@ class DatabaseIface:
         """
 
         logger.info("Status changed to " + stat.name)
-        self.db.set(SCHEMA.STATUS, stat.name)  # FIXME
+        self.db.set(SCHEMA.STATUS, "Status." + stat.name)
         self.db.publish(self.CHANNEL, "Status." + stat.name)
 
         return stat
 
-
-iface = DatabaseIface(clear=True)
-iface.connect()
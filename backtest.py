@@ -0,0 +1,297 @@
+"""
+backtest.py - card sequence backtester
+
+runs recorded card sequences through counting systems and a bet ramp. sequence
+files hold one byte per card, its rank int (as in session snapshots), with
+`SHUFFLE` bytes marking a new shoe. files are memory-mapped and processed in
+fixed-size chunks with numpy, so they are never loaded whole.
+
+`run_recorder` keeps a sequence file growing from the event stream through the
+`persist` consumer group. the shoe in play is kept in a json sidecar
+(`<path>.state`) together with the id of the last event applied and the size of
+the file, and is only appended, with its shuffle marker, once the next shoe
+starts; cards put back are taken off the shoe in play. on start the file is cut
+back to the size the sidecar records, so events replayed after a crash are never
+recorded twice.
+
+recorded cards carry no hand outcomes, so each round is valued with the usual
+linear edge model: `base_edge + edge_per_tc * tc` per unit bet, where a round
+starts every `cards_per_round` cards of a shoe.
+"""
+
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+from loguru import logger
+
+from accumulators import TC_MAX, TC_MIN
+from events import Consumer, stream_id
+from rain import RANK_INDEX, RANK_NAMES, TAGS
+
+#
+#   Constants
+#
+
+SHUFFLE = 0xFF
+
+# cards per chunk; every working array is a small multiple of this
+CHUNK = 1 << 20
+
+RECORD_GROUP = "persist"
+
+# tags indexed by rank int (2 3 4 5 6 7 8 9 10 J Q K A), and the number of
+# points per hi-lo point used to normalize the true count
+System = namedtuple("System", "tags scale")
+
+SYSTEMS = {
+    "hilo": System(TAGS, 1),
+    "hiopt1": System([0, 1, 1, 1, 1, 0, 0, 0, -1, -1, -1, -1, 0], 1),
+    "hiopt2": System([1, 1, 2, 2, 1, 1, 0, 0, -2, -2, -2, -2, 0], 2),
+    "omega2": System([1, 1, 2, 2, 2, 1, 0, -1, -2, -2, -2, -2, 0], 2),
+    "zen": System([1, 1, 2, 2, 2, 1, 0, 0, -2, -2, -2, -2, -1], 2),
+    # halves, doubled to stay integral
+    "halves": System([1, 2, 2, 3, 2, 1, 0, -1, -2, -2, -2, -2, -2], 2),
+}
+
+Result = namedtuple("Result", "system cards shoes rounds wagered expected tc_hist")
+
+
+def write_sequence(path, ranks, shuffle=True):
+    """
+    appends a shoe of rank names to a sequence file, followed by a shuffle marker.
+    """
+
+    data = bytes(RANK_INDEX[rank] for rank in ranks)
+
+    with open(path, "ab") as f:
+        f.write(data + (bytes([SHUFFLE]) if shuffle else b""))
+
+    return len(data)
+
+
+class Recorder:
+    """
+    applies card and shoe events to a sequence file (see the module docstring).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state_path = f"{path}.state"
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+
+            self.last_id, self.size, self.shoe = state["id"], state["size"], state["shoe"]
+        else:
+            # a file recorded some other way is kept whole
+            self.last_id = "0-0"
+            self.size = os.path.getsize(path) if os.path.exists(path) else 0
+            self.shoe = []
+
+        with open(self.path, "ab") as f:
+            f.truncate(self.size)
+
+    def apply(self, events):
+        """
+        applies a batch of events, skipping any at or before the last one
+        applied, then saves the sidecar.
+        """
+
+        out = bytearray()
+
+        for i, fields in events:
+            if not fields or stream_id(i) <= stream_id(self.last_id):
+                continue
+
+            self.last_id = i
+            kind = fields.get("kind")
+
+            if kind == "remove":
+                self.shoe.extend([RANK_INDEX[fields["rank"]]] * int(fields.get("n", 1)))
+
+            elif kind == "replace":
+                rank = RANK_INDEX[fields["rank"]]
+
+                for _ in range(int(fields.get("n", 1))):
+                    if rank in self.shoe:
+                        del self.shoe[len(self.shoe) - 1 - self.shoe[::-1].index(rank)]
+
+            elif kind == "shoe" and self.shoe:
+                out += bytes(self.shoe) + bytes([SHUFFLE])
+                self.shoe = []
+
+        if out:
+            with open(self.path, "ab") as f:
+                f.write(out)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.size += len(out)
+
+        self._save()
+
+    def _save(self):
+        tmp = f"{self.state_path}.tmp"
+
+        with open(tmp, "w") as f:
+            json.dump({"id": self.last_id, "size": self.size, "shoe": self.shoe}, f)
+
+        os.replace(tmp, self.state_path)
+
+
+def run_recorder(s, path, name=None):
+    """
+    runs the sequence recorder consumer group worker forever.
+    """
+
+    recorder = Recorder(path)
+
+    logger.info(f"recording to {path} after event {recorder.last_id}.")
+    Consumer(s, RECORD_GROUP, name).run(recorder.apply)
+
+
+def _tag_table(system):
+    """
+    256-entry lookup from card byte to tag; shuffle markers (and anything else)
+    tag as 0.
+    """
+
+    table = np.zeros(256, dtype=np.int32)
+    table[: len(RANK_NAMES)] = system.tags
+    return table
+
+
+class _Backtest:
+    """
+    chunked running state for one system.
+    """
+
+    def __init__(self, name, system, decks, spread, cards_per_round, base_edge, edge_per_tc):
+        self.name = name
+        self.system = system
+        self.table = _tag_table(system)
+        self.shoe_cards = 52 * decks
+        self.spread = spread
+        self.cards_per_round = cards_per_round
+        self.base_edge = base_edge
+        self.edge_per_tc = edge_per_tc
+
+        # carried across chunks
+        self.run = 0
+        self.dealt = 0
+
+        self.cards = 0
+        self.shoes = 0
+        self.rounds = 0
+        self.wagered = 0.0
+        self.expected = 0.0
+        self.tc_hist = np.zeros(TC_MAX - TC_MIN + 1, dtype=np.int64)
+
+    def feed(self, codes):
+        n = len(codes)
+        idx = np.arange(n, dtype=np.int32)
+        marker = codes == SHUFFLE
+
+        # index of the last shuffle at or before each card, or -1
+        last = np.where(marker, idx, -1)
+        np.maximum.accumulate(last, out=last)
+        reset = last >= 0
+        anchor = np.where(reset, last, 0)
+
+        tags = self.table[codes]
+        run = np.cumsum(tags, dtype=np.int32)
+        dealt = np.cumsum(~marker, dtype=np.int32)
+
+        # counts after each card, restarting at every shuffle
+        run = np.where(reset, run - run[anchor], run + self.run)
+        dealt = np.where(reset, dealt - dealt[anchor], dealt + self.dealt)
+
+        # counts before each card, at which a round's bet is sized
+        run_before = run - tags
+        dealt_before = dealt - 1
+
+        starts = ~marker & (dealt_before % self.cards_per_round == 0)
+        left = self.shoe_cards - dealt_before[starts]
+
+        tc = run_before[starts] / self.system.scale / (np.maximum(left, 1) / 52)
+        bets = np.clip(np.floor(tc), 1, self.spread)
+
+        self.cards += int(n - marker.sum())
+        self.shoes += int(marker.sum())
+        self.rounds += int(starts.sum())
+        self.wagered += float(bets.sum())
+        self.expected += float((bets * (self.base_edge + self.edge_per_tc * tc)).sum())
+        self.tc_hist += np.bincount(
+            np.clip(np.floor(tc + 0.5), TC_MIN, TC_MAX).astype(np.int64) - TC_MIN,
+            minlength=len(self.tc_hist),
+        )
+
+        self.run = int(run[-1])
+        self.dealt = int(dealt[-1])
+
+    def result(self):
+        return Result(
+            self.name,
+            self.cards,
+            self.shoes,
+            self.rounds,
+            self.wagered,
+            self.expected,
+            dict(zip(range(TC_MIN, TC_MAX + 1), self.tc_hist.tolist())),
+        )
+
+
+def backtest(
+    path,
+    systems=None,
+    decks=6,
+    spread=8,
+    cards_per_round=6,
+    base_edge=-0.005,
+    edge_per_tc=0.005,
+    chunk=CHUNK,
+):
+    """
+    runs the sequence file at `path` through each counting system.
+
+    :returns: list of Result, money in betting units
+    """
+
+    systems = systems or list(SYSTEMS)
+    tests = [
+        _Backtest(name, SYSTEMS[name], decks, spread, cards_per_round, base_edge, edge_per_tc)
+        for name in systems
+    ]
+
+    cards = np.memmap(path, dtype=np.uint8, mode="r")
+    logger.info(f"backtesting {len(cards)} bytes of {path} against {', '.join(systems)}.")
+
+    for start in range(0, len(cards), chunk):
+        codes = np.asarray(cards[start:start + chunk])
+
+        for test in tests:
+            test.feed(codes)
+
+    return [test.result() for test in tests]
+
+
+def report(results, unit=1.0, bankroll=None):
+    """
+    prints results, converting units to dollars with a unit bet of `unit`.
+    """
+
+    for r in results:
+        line = (
+            f"{r.system:8s} {r.cards:12d} cards {r.rounds:10d} rounds "
+            f"avg bet {r.wagered / max(r.rounds, 1):5.2f} "
+            f"ev ${unit * r.expected:+12.2f} "
+            f"({100 * r.expected / max(r.wagered, 1):+.3f}%)"
+        )
+
+        if bankroll:
+            line += f" {100 * unit * r.expected / bankroll:+.1f}% of bankroll"
+
+        logger.success(line)
@@ -0,0 +1,371 @@
+"""
+charts.py - basic strategy chart generator
+
+computes basic strategy charts from first principles for every (decks, rules)
+variant the strategy engine in `strategy/new.html` offers: 1-8 decks, H17/S17,
+double after split, late surrender and resplitting. the dealer's final totals come
+from an exact recursion over the shoe composition (less the upcard, with peek for
+blackjack); the player's decisions are then evaluated against them.
+
+each variant is computed in its own worker process, and finished charts are cached
+on disk as json keyed by a hash of the rules.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+from loguru import logger
+
+#
+#   Constants
+#
+
+# bump whenever the computation changes so stale cached charts are ignored
+CHART_VERSION = 1
+
+CHART_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "charts")
+
+# card values 2-11 (11 is the ace); index `value - 2` into a composition tuple
+VALUES = list(range(2, 12))
+LABELS = [str(v) for v in range(2, 11)] + ["A"]
+
+# dealer outcomes: final totals 17-21, then bust
+OUTCOMES = 6
+BUST = 5
+
+HARD_ROWS = range(5, 21)
+SOFT_ROWS = range(13, 21)
+
+MAX_HANDS = 4
+
+Rules = namedtuple("Rules", "decks h17 das surrender resplit")
+
+DEFAULT_RULES = Rules(decks=6, h17=False, das=True, surrender=False, resplit=True)
+
+
+def rule_hash(rules):
+    """
+    returns a short, stable hash identifying the rules (and chart version).
+    """
+
+    key = json.dumps(dict(rules._asdict(), version=CHART_VERSION), sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def all_rules(decks=range(1, 9)):
+    """
+    every rule variant for the given numbers of decks.
+    """
+
+    return [
+        Rules(d, h17, das, surrender, resplit)
+        for d in decks
+        for h17, das, surrender, resplit in itertools.product((False, True), repeat=4)
+    ]
+
+
+#
+#   Dealer recursion
+#
+
+
+def shoe_composition(decks):
+    """
+    count of each value 2-11 in a fresh shoe; tens, jacks, queens and kings
+    all count as ten.
+    """
+
+    return tuple(16 * decks if v == 10 else 4 * decks for v in VALUES)
+
+
+def add_card(total, soft, value):
+    """
+    adds a card value to a hand total, tracking whether an ace counts as 11.
+    """
+
+    if value == 11:
+        if total + 11 <= 21:
+            return total + 11, True
+        value = 1
+
+    total += value
+
+    if total > 21 and soft:
+        return total - 10, False
+
+    return total, soft
+
+
+def dealer_probabilities(composition, upcard, h17):
+    """
+    probabilities of the dealer finishing on 17, 18, 19, 20, 21 or busting,
+    given the upcard and that the dealer has already peeked for blackjack.
+    """
+
+    @lru_cache(maxsize=None)
+    def draw(total, soft, counts):
+        if total > 21:
+            return tuple(1.0 if i == BUST else 0.0 for i in range(OUTCOMES))
+
+        if total >= 17 and not (h17 and soft and total == 17):
+            return tuple(1.0 if i == total - 17 else 0.0 for i in range(OUTCOMES))
+
+        n = sum(counts)
+        acc = [0.0] * OUTCOMES
+
+        for i, c in enumerate(counts):
+            if not c:
+                continue
+
+            rest = counts[:i] + (c - 1,) + counts[i + 1:]
+            res = draw(*add_card(total, soft, VALUES[i]), rest)
+
+            for k in range(OUTCOMES):
+                acc[k] += c / n * res[k]
+
+        return tuple(acc)
+
+    counts = list(composition)
+    counts[upcard - 2] -= 1
+
+    # the hole card cannot complete a blackjack, since the dealer peeked
+    hole = list(counts)
+    if upcard == 11:
+        hole[10 - 2] = 0
+    elif upcard == 10:
+        hole[11 - 2] = 0
+
+    n = sum(hole)
+    acc = [0.0] * OUTCOMES
+    total, soft = add_card(0, False, upcard)
+
+    for i, c in enumerate(hole):
+        if not c:
+            continue
+
+        rest = counts[:]
+        rest[i] -= 1
+        res = draw(*add_card(total, soft, VALUES[i]), tuple(rest))
+
+        for k in range(OUTCOMES):
+            acc[k] += c / n * res[k]
+
+    return acc
+
+
+#
+#   Player decisions
+#
+
+
+class Evaluator:
+    """
+    expected values of each player action against one dealer upcard.
+
+    the player's draws use the shoe composition less the upcard; removal of the
+    player's own cards is ignored, as in most published basic strategy engines.
+    """
+
+    def __init__(self, rules, upcard):
+        self.rules = rules
+        composition = list(shoe_composition(rules.decks))
+        composition[upcard - 2] -= 1
+
+        n = sum(composition)
+        self.probs = [c / n for c in composition]
+        self.dealer = dealer_probabilities(
+            shoe_composition(rules.decks), upcard, rules.h17
+        )
+        self._hit = {}
+
+    def stand(self, total):
+        if total > 21:
+            return -1.0
+
+        bust = self.dealer[BUST]
+
+        win = bust + sum(self.dealer[k] for k in range(BUST) if total > 17 + k)
+        lose = sum(self.dealer[k] for k in range(BUST) if total < 17 + k)
+
+        return win - lose
+
+    def hit(self, total, soft):
+        key = (total, soft)
+
+        if key not in self._hit:
+            ev = 0.0
+
+            for p, value in zip(self.probs, VALUES):
+                t, s = add_card(total, soft, value)
+                ev += p * (-1.0 if t > 21 else max(self.stand(t), self.hit(t, s)))
+
+            self._hit[key] = ev
+
+        return self._hit[key]
+
+    def double(self, total, soft):
+        ev = 0.0
+
+        for p, value in zip(self.probs, VALUES):
+            t, _ = add_card(total, soft, value)
+            ev += p * self.stand(t)
+
+        return 2 * ev
+
+    def actions(self, total, soft, doubles=True, surrender=True):
+        """
+        ev of every action allowed on a two card hand.
+        """
+
+        evs = {"S": self.stand(total), "H": self.hit(total, soft)}
+
+        if doubles:
+            evs["D"] = self.double(total, soft)
+
+        if surrender and self.rules.surrender:
+            evs["R"] = -0.5
+
+        return evs
+
+    def split(self, value):
+        """
+        ev of splitting a pair of `value`, counting every resulting hand.
+        """
+
+        def hand(depth):
+            ev = 0.0
+
+            for p, second in zip(self.probs, VALUES):
+                total, soft = add_card(*add_card(0, False, value), second)
+
+                if value == 11:
+                    # split aces take one card each and cannot be resplit
+                    best = self.stand(total)
+                else:
+                    evs = self.actions(total, soft, self.rules.das, surrender=False)
+                    best = max(evs.values())
+
+                    if second == value and self.rules.resplit and depth < MAX_HANDS:
+                        best = max(best, 2 * hand(depth + 1))
+
+                ev += p * best
+
+            return ev
+
+        return 2 * hand(2)
+
+
+def best_action(evs):
+    """
+    turns action evs into a chart code: the best action, and for doubling or
+    surrender, what to do when it is not allowed (e.g. "Dh", "Rs").
+    """
+
+    ranked = sorted(evs, key=evs.get, reverse=True)
+    best = ranked[0]
+
+    if best in ("D", "R"):
+        fallback = next(a for a in ranked if a in ("H", "S", "P"))
+        return best + fallback.lower()
+
+    return best
+
+
+def generate_chart(rules):
+    """
+    computes the hard, soft and pair charts for one rule variant.
+    """
+
+    chart = {"rules": rules._asdict(), "hash": rule_hash(rules)}
+    hard, soft, pairs = {}, {}, {}
+
+    for upcard, label in zip(VALUES, LABELS):
+        ev = Evaluator(rules, upcard)
+
+        for total in HARD_ROWS:
+            hard.setdefault(str(total), {})[label] = best_action(
+                ev.actions(total, False)
+            )
+
+        for total in SOFT_ROWS:
+            soft.setdefault(str(total), {})[label] = best_action(
+                ev.actions(total, True)
+            )
+
+        for value, pair in zip(VALUES, LABELS):
+            evs = ev.actions(*add_card(*add_card(0, False, value), value))
+            evs["P"] = ev.split(value)
+            pairs.setdefault(pair, {})[label] = best_action(evs)
+
+    chart.update(hard=hard, soft=soft, pairs=pairs)
+
+    return chart
+
+
+#
+#   Disk cache
+#
+
+
+def chart_path(rules, directory=CHART_DIR):
+    return os.path.join(directory, rule_hash(rules) + ".json")
+
+
+def save_chart(chart, directory=CHART_DIR):
+    os.makedirs(directory, exist_ok=True)
+    path = chart_path(Rules(**chart["rules"]), directory)
+
+    with open(path, "w") as f:
+        json.dump(chart, f, indent=1, sort_keys=True)
+
+    return path
+
+
+def load_chart(rules=DEFAULT_RULES, directory=CHART_DIR):
+    """
+    returns the chart for the rules, computing and caching it if needed.
+    """
+
+    path = chart_path(rules, directory)
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.info(f"no cached chart for {rules}, computing it.")
+
+    chart = generate_chart(rules)
+    save_chart(chart, directory)
+
+    return chart
+
+
+def generate_all(variants=None, workers=None, directory=CHART_DIR, force=False):
+    """
+    computes every missing variant across a process pool and caches the charts.
+
+    :returns: list of the paths written
+    """
+
+    variants = variants if variants is not None else all_rules()
+
+    if not force:
+        variants = [r for r in variants if not os.path.exists(chart_path(r, directory))]
+
+    logger.info(f"generating {len(variants)} strategy charts.")
+
+    paths = []
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(generate_chart, r): r for r in variants}
+
+        for future in as_completed(futures):
+            paths.append(save_chart(future.result(), directory))
+            logger.success(f"chart for {futures[future]} done.")
+
+    return paths
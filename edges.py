@@ -0,0 +1,249 @@
+"""
+edges.py - true count to player edge lookup tables
+
+simulates flat-bet basic strategy play for one (decks, rules, count system)
+combination and tabulates the player's edge and variance per true count bucket
+and penetration band. tables are stored as compressed numpy archives under
+`edges/`, keyed by a hash of the combination, and loaded once at startup; a
+lookup is a constant-time bilinear interpolation.
+
+cells with too few rounds to pin the edge down to `TARGET_SE` are filled from a
+weighted linear fit of edge on true count within their penetration band.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+from loguru import logger
+
+from accumulators import TC_MAX, TC_MIN, Accumulator, tc_bucket
+from backtest import SYSTEMS
+from charts import DEFAULT_RULES, load_chart
+from sim import (
+    DEFAULT_PENETRATION,
+    DEFAULT_SHARDS,
+    Shoe,
+    Strategy,
+    play_round,
+    run_sharded,
+    value_tags,
+)
+
+#
+#   Constants
+#
+
+# part of every table key: tables built by an older computation hash to a
+# different file and are simply not found
+TABLE_VERSION = 3
+
+EDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "edges")
+
+PEN_BANDS = 10
+
+# standard error per unit bet a cell must reach to be used as measured. a
+# hand's variance is about 1.3, so this takes ~200k rounds per cell; the edge
+# only moves ~0.5% per true count, and noisier cells are taken from the fit
+TARGET_SE = 0.0025
+
+TCS = np.arange(TC_MIN, TC_MAX + 1)
+
+# rule of thumb used when no table has been built: -0.5% off the top, +0.5% per
+# hi-lo true count
+FALLBACK_BASE = -0.005
+FALLBACK_SLOPE = 0.005
+
+
+def table_key(rules, system):
+    key = json.dumps(
+        dict(rules._asdict(), system=system, version=TABLE_VERSION), sort_keys=True
+    )
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def table_path(rules, system, directory=EDGE_DIR):
+    return os.path.join(directory, table_key(rules, system) + ".npz")
+
+
+#
+#   Building
+#
+
+
+def run_shard(seed, rounds, rules, chart, system, penetration):
+    """
+    plays `rounds` flat-bet rounds, accumulating results per (band, bucket).
+    """
+
+    rng = np.random.default_rng(seed)
+    shoe = Shoe(rng, rules.decks, penetration, value_tags(SYSTEMS[system].tags), SYSTEMS[system].scale)
+    strategy = Strategy(chart)
+    grid = [[Accumulator() for _ in TCS] for _ in range(PEN_BANDS)]
+
+    for _ in range(rounds):
+        if shoe.pos >= shoe.cut:
+            shoe.shuffle()
+
+        band = min(PEN_BANDS - 1, int(shoe.penetration * PEN_BANDS))
+        bucket = tc_bucket(shoe.true_count) - TC_MIN
+
+        grid[band][bucket].add(play_round(shoe, strategy, rules))
+
+    return grid
+
+
+def _fill(mean, n, min_rounds):
+    """
+    replaces cells with fewer than `min_rounds` rounds with a linear fit within
+    their band, each cell weighted by its rounds.
+    """
+
+    for band in range(PEN_BANDS):
+        w = n[band].astype(float)
+
+        if w.sum() == 0:
+            # nothing dealt this deep; fall back to the whole table
+            w = n.sum(axis=0).astype(float)
+            m = np.divide((mean * n).sum(axis=0), w, out=np.zeros_like(mean[0]), where=w > 0)
+        else:
+            m = mean[band]
+
+        slope, base = np.polyfit(TCS, m, 1, w=np.sqrt(w)) if (w > 0).sum() > 1 else (0.0, 0.0)
+        thin = n[band] < min_rounds
+        mean[band, thin] = base + slope * TCS[thin]
+
+    return mean
+
+
+def build_table(
+    rules=DEFAULT_RULES,
+    system="hilo",
+    rounds=10000000,
+    seed=0,
+    shards=DEFAULT_SHARDS,
+    workers=None,
+    penetration=DEFAULT_PENETRATION,
+    directory=EDGE_DIR,
+):
+    """
+    simulates and writes the edge table for one combination.
+
+    :returns: path of the table
+    """
+
+    chart = load_chart(rules)
+
+    logger.info(f"building {system} edge table for {rules} from {rounds} rounds.")
+
+    grid = [[Accumulator() for _ in TCS] for _ in range(PEN_BANDS)]
+
+    for result in run_sharded(
+        run_shard, rounds, seed, shards, workers, rules, chart, system, penetration
+    ):
+        for row, other in zip(grid, result):
+            for acc, o in zip(row, other):
+                acc.merge(o)
+
+    n = np.array([[acc.n for acc in row] for row in grid], dtype=np.int64)
+    mean = np.array([[acc.mean for acc in row] for row in grid])
+    var = np.array([[acc.variance for acc in row] for row in grid])
+
+    pooled = np.average(var, weights=n) if n.any() else 1.3
+    min_rounds = int(pooled / TARGET_SE ** 2)
+
+    mean = _fill(mean, n, min_rounds)
+    var[n < min_rounds] = pooled
+
+    os.makedirs(directory, exist_ok=True)
+    path = table_path(rules, system, directory)
+
+    np.savez_compressed(
+        path,
+        edge=mean.astype(np.float32),
+        var=var.astype(np.float32),
+        n=n,
+        meta=json.dumps(
+            dict(rules._asdict(), system=system, rounds=rounds, seed=seed, min_rounds=min_rounds)
+        ),
+    )
+
+    logger.success(f"wrote edge table {path}.")
+
+    return path
+
+
+#
+#   Lookup
+#
+
+
+class EdgeTable:
+    """
+    edge and variance per unit bet as a function of true count and penetration.
+    """
+
+    def __init__(self, edge, var, meta=None):
+        self.edge_grid = edge
+        self.var_grid = var
+        self.meta = meta or {}
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["edge"], data["var"], json.loads(str(data["meta"])))
+
+    def _interp(self, grid, tc, pen):
+        x = min(max(tc, TC_MIN), TC_MAX) - TC_MIN
+        y = min(max(pen * PEN_BANDS - 0.5, 0), PEN_BANDS - 1)
+
+        x0, y0 = min(int(x), len(TCS) - 2), min(int(y), PEN_BANDS - 2)
+        fx, fy = x - x0, y - y0
+
+        top = grid[y0, x0] * (1 - fx) + grid[y0, x0 + 1] * fx
+        bottom = grid[y0 + 1, x0] * (1 - fx) + grid[y0 + 1, x0 + 1] * fx
+
+        return float(top * (1 - fy) + bottom * fy)
+
+    def edge(self, tc, pen):
+        return self._interp(self.edge_grid, tc, pen)
+
+    def variance(self, tc, pen):
+        return self._interp(self.var_grid, tc, pen)
+
+    def kelly(self, tc, pen):
+        """
+        fraction of bankroll to bet: edge over variance, never negative.
+        """
+
+        return max(0.0, self.edge(tc, pen)) / self.variance(tc, pen)
+
+
+class FallbackTable(EdgeTable):
+    """
+    the linear rule of thumb, used until a table is built.
+    """
+
+    def __init__(self):
+        self.meta = {"fallback": True}
+
+    def edge(self, tc, pen):
+        return FALLBACK_BASE + FALLBACK_SLOPE * tc
+
+    def variance(self, tc, pen):
+        return 1.3
+
+
+def load_table(rules=DEFAULT_RULES, system="hilo", directory=EDGE_DIR):
+    """
+    loads the table for the combination, or the fallback if none is built.
+    """
+
+    path = table_path(rules, system, directory)
+
+    if os.path.exists(path):
+        return EdgeTable.load(path)
+
+    logger.warning(f"no {system} edge table for {rules}; using the linear estimate.")
+    return FallbackTable()
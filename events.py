@@ -0,0 +1,134 @@
+"""
+events.py - consumer groups on the rainman event stream
+
+card, status, phase and fund events are appended to the capped stream
+`sys:events` next to the fire-and-forget pubsub messages. each kind of worker
+reads the stream through its own consumer group, so a slow or restarting worker
+never loses events or slows card entry: it acknowledges in batches, and on
+restart first replays what it had read but not acknowledged, then catches up on
+everything appended while it was down.
+
+the statistics worker (`stats.py`) and the sequence recorder (`backtest.py`)
+are such groups; any other group can be followed with the generic printer,
+`rainman events GROUP`. the dashboards only show the latest state, so they stay
+on the pubsub channel.
+"""
+
+import json
+
+import redis
+from loguru import logger
+
+from rain import STREAM
+
+#
+#   Constants
+#
+
+BATCH = 256
+BLOCK = 5000  # ms
+
+
+def stream_id(i):
+    """
+    a stream entry id as a comparable (ms, seq) tuple.
+    """
+
+    ms, seq = i.split("-")
+    return int(ms), int(seq)
+
+
+class Consumer:
+    """
+    one member of a consumer group on the event stream.
+    """
+
+    def __init__(self, s, group, name=None, batch=BATCH, block=BLOCK):
+        self.s = s
+        self.group = group
+        self.name = name or f"{group}-1"
+        self.batch = batch
+        self.block = block
+
+    def ensure_group(self):
+        """
+        creates the group (and stream) if needed; a new group starts from the
+        beginning of the stream so it sees the retained history.
+        """
+
+        try:
+            self.s.xgroup_create(STREAM, self.group, id="0", mkstream=True)
+            logger.info(f"created consumer group '{self.group}'.")
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, pending=False):
+        """
+        reads the next batch of events.
+
+        :param pending: re-read events delivered to this consumer but not acked
+        :returns: list of (id, fields)
+        """
+
+        try:
+            reply = self.s.xreadgroup(
+                self.group,
+                self.name,
+                {STREAM: "0" if pending else ">"},
+                count=self.batch,
+                block=None if pending else self.block,
+            )
+        except redis.ResponseError as e:
+            if "NOGROUP" not in str(e) and "UNBLOCKED" not in str(e):
+                raise
+
+            # the stream or group was deleted, possibly while we were blocked
+            # on it (redis then unblocks us with UNBLOCKED); start over
+            self.ensure_group()
+            return []
+
+        return reply[0][1] if reply else []
+
+    def ack(self, events):
+        if events:
+            self.s.xack(STREAM, self.group, *(i for i, _ in events))
+
+    def run(self, handler, forever=True):
+        """
+        feeds batches of events to `handler` and acknowledges each batch once
+        the handler returns. pending events are replayed first.
+        """
+
+        self.ensure_group()
+
+        events = self.read(pending=True)
+        while events:
+            logger.info(f"{self.name}: replaying {len(events)} pending events.")
+            handler(events)
+            self.ack(events)
+            events = self.read(pending=True)
+
+        while True:
+            events = self.read()
+
+            if events:
+                handler(events)
+                self.ack(events)
+
+            elif not forever:
+                return
+
+    def lag(self):
+        """
+        number of events not yet delivered to the group, if redis reports it.
+        """
+
+        for group in self.s.xinfo_groups(STREAM):
+            if group["name"] == self.group:
+                return group.get("lag")
+
+
+def print_events(events):
+    for i, fields in events:
+        print(i, json.dumps(fields))
@@ -0,0 +1,354 @@
+"""
+ledger.py - bet, win and loss ledger (Command.BET, WIN, LOSS)
+
+every bet and settlement is one lua script, so the ledger entry, the bankroll in
+`funds` and the running aggregates change together or not at all. money is kept
+in integer cents throughout.
+
+keys
+====
+
+* `ledger:seq`: last bet id
+* `ledger:shoe`: current shoe number, bumped by `init_session`
+* `ledger:open`: open bets, `id -> "cents:tc:shoe"`
+* `ledger:log`: stream of every bet and settlement
+* `ledger:agg:session`, `ledger:agg:shoe:<n>`: aggregates for the session and per shoe
+* `ledger:agg:tc`: aggregates per true count bucket, fields `<tc>:<name>`
+
+the aggregates (bets, wagered, hands, net, wins, losses, pushes) are updated as
+entries are written, so P&L and ev-by-count never scan the ledger.
+"""
+
+import csv
+
+from loguru import logger
+
+from accumulators import TC_MAX, TC_MIN
+from rain import CHANNEL, STREAM, STREAM_MAXLEN, Command
+
+#
+#   Constants
+#
+
+SEQ = "ledger:seq"
+SHOE = "ledger:shoe"
+OPEN = "ledger:open"
+LOG = "ledger:log"
+AGG_SESSION = "ledger:agg:session"
+AGG_SHOE = "ledger:agg:shoe:"
+AGG_TC = "ledger:agg:tc"
+
+EXPORT_FIELDS = ["id", "kind", "bet", "net", "tc", "shoe", "ts"]
+
+# KEYS: run, left, funds, seq, shoe, open, log, session agg, tc agg, shoe agg
+# ARGV: cents, tc min, tc max, shoe the shoe agg key was built for
+_BET = """
+local shoe = redis.call('GET', KEYS[5]) or '0'
+if shoe ~= ARGV[4] then
+    return {0, shoe}
+end
+
+local cents = tonumber(ARGV[1])
+local run = tonumber(redis.call('GET', KEYS[1]) or '0')
+local left = tonumber(redis.call('GET', KEYS[2]) or '0')
+
+local tc = 0
+if left > 0 then
+    tc = math.floor(run / (left / 52) + 0.5)
+end
+tc = math.max(tonumber(ARGV[2]), math.min(tonumber(ARGV[3]), tc))
+
+local id = redis.call('INCR', KEYS[4])
+
+redis.call('HSET', KEYS[6], id, cents .. ':' .. tc .. ':' .. shoe)
+redis.call('DECRBY', KEYS[3], cents)
+redis.call('XADD', KEYS[7], '*', 'id', id, 'kind', 'bet', 'bet', cents, 'net', 0, 'tc', tc, 'shoe', shoe)
+
+for _, agg in ipairs({KEYS[8], KEYS[10]}) do
+    redis.call('HINCRBY', agg, 'bets', 1)
+    redis.call('HINCRBY', agg, 'wagered', cents)
+end
+redis.call('HINCRBY', KEYS[9], tc .. ':bets', 1)
+redis.call('HINCRBY', KEYS[9], tc .. ':wagered', cents)
+
+return {id, tc}
+"""
+
+# KEYS: funds, open, log, session agg, tc agg, event stream, shoe agg of the bet
+# ARGV: id, multiplier, event stream maxlen
+_SETTLE = """
+local entry = redis.call('HGET', KEYS[2], ARGV[1])
+if not entry then
+    return false
+end
+
+local cents, tc, shoe = string.match(entry, '([^:]+):([^:]+):([^:]+)')
+cents = tonumber(cents)
+
+local net = math.floor(cents * tonumber(ARGV[2]) + 0.5)
+
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('INCRBY', KEYS[1], cents + net)
+redis.call('XADD', KEYS[3], '*', 'id', ARGV[1], 'kind', 'settle', 'bet', cents, 'net', net, 'tc', tc, 'shoe', shoe)
+
+local outcome = 'pushes'
+if net > 0 then
+    outcome = 'wins'
+elseif net < 0 then
+    outcome = 'losses'
+end
+
+for _, agg in ipairs({KEYS[4], KEYS[7]}) do
+    redis.call('HINCRBY', agg, 'hands', 1)
+    redis.call('HINCRBY', agg, 'net', net)
+    redis.call('HINCRBY', agg, outcome, 1)
+end
+redis.call('HINCRBY', KEYS[5], tc .. ':hands', 1)
+redis.call('HINCRBY', KEYS[5], tc .. ':net', net)
+redis.call('HINCRBY', KEYS[5], tc .. ':' .. outcome, 1)
+
+redis.call('XADD', KEYS[6], 'MAXLEN', '~', ARGV[3], '*', 'kind', 'settle', 'tc', tc, 'bet', cents, 'net', net)
+
+return {cents, tonumber(tc), net}
+"""
+
+
+def _cents(amount):
+    return int(round(float(amount) * 100))
+
+
+def place_bet(s, amount):
+    """
+    records a bet of `amount` dollars at the current true count and takes it
+    out of funds.
+
+    :returns: the bet id, or None if `amount` is not a positive bet
+    """
+
+    cents = _cents(amount)
+
+    if cents <= 0:
+        logger.warning(f"cannot bet ${float(amount):.2f}.")
+        s.publish(CHANNEL, f"ERR:Could not bet {amount}.")
+        return None
+
+    script = s.register_script(_BET)
+    shoe = s.get(SHOE) or "0"
+
+    while True:
+        # the shoe aggregate key must be declared up front; if a new shoe
+        # started in between, the script refuses and we retry with its key
+        bet_id, tc = script(
+            keys=[
+                "run", "left", "funds", SEQ, SHOE, OPEN, LOG, AGG_SESSION, AGG_TC,
+                AGG_SHOE + str(shoe),
+            ],
+            args=[cents, TC_MIN, TC_MAX, shoe],
+        )
+
+        if bet_id:
+            break
+
+        shoe = tc
+
+    logger.info(f"bet #{bet_id}: ${float(amount):.2f} at TC {tc:+d}")
+    s.publish(CHANNEL, f"{Command.BET} {bet_id} {float(amount):.2f}")
+
+    return bet_id
+
+
+def settle(s, bet_id, mult):
+    """
+    settles an open bet, paying `mult` times the bet (1 for an even money win,
+    1.5 for blackjack, 0 for a push, -1 for a loss, -0.5 for surrender).
+
+    :returns: net result in dollars, or None if there is no such open bet
+    """
+
+    # an open bet's entry never changes until it is settled, so its shoe can be
+    # read ahead to declare the shoe aggregate key
+    entry = s.hget(OPEN, bet_id)
+    result = entry and s.register_script(_SETTLE)(
+        keys=[
+            "funds", OPEN, LOG, AGG_SESSION, AGG_TC, STREAM,
+            AGG_SHOE + entry.split(":")[2],
+        ],
+        args=[bet_id, mult, STREAM_MAXLEN],
+    )
+
+    if not result:
+        logger.warning(f"no open bet #{bet_id}.")
+        return None
+
+    cents, tc, net = result
+
+    logger.info(f"bet #{bet_id} settled: ${net / 100:+.2f} (TC {tc:+d})")
+
+    if net:
+        command = Command.WIN if net > 0 else Command.LOSS
+        s.publish(CHANNEL, f"{command} {bet_id} {abs(net) / 100:.2f}")
+    else:
+        # a push only hands the stake back, but funds still changed
+        s.publish(CHANNEL, f"{Command.FUNDS} ADD {cents / 100:.2f}")
+
+    return net / 100
+
+
+def win(s, bet_id, mult=1.0):
+    return settle(s, bet_id, mult)
+
+
+def loss(s, bet_id, mult=1.0):
+    return settle(s, bet_id, -mult)
+
+
+def push(s, bet_id):
+    return settle(s, bet_id, 0)
+
+
+def open_bets(s):
+    """
+    :returns: dict of open bet id to (cents, tc, shoe)
+    """
+
+    return {
+        int(i): tuple(int(v) for v in entry.split(":"))
+        for i, entry in s.hgetall(OPEN).items()
+    }
+
+
+#
+#   Aggregates
+#
+
+
+def pnl(s, shoe=None):
+    """
+    aggregates for the session, or for one shoe; money in cents.
+    """
+
+    key = AGG_SESSION if shoe is None else AGG_SHOE + str(shoe)
+    return {k: int(v) for k, v in s.hgetall(key).items()}
+
+
+def ev_by_count(s):
+    """
+    aggregates per true count bucket, with the ev per dollar wagered on
+    settled hands.
+    """
+
+    buckets = {}
+
+    for field, value in s.hgetall(AGG_TC).items():
+        tc, name = field.split(":")
+        buckets.setdefault(int(tc), {})[name] = int(value)
+
+    for agg in buckets.values():
+        wagered = agg.get("wagered", 0)
+        agg["ev"] = agg.get("net", 0) / wagered if wagered else 0.0
+
+    return dict(sorted(buckets.items()))
+
+
+def report(s, shoe=None):
+    agg = pnl(s, shoe)
+    wagered = agg.get("wagered", 0)
+
+    logger.info(f"{'session' if shoe is None else f'shoe {shoe}'}: {agg.get('hands', 0)} hands")
+    logger.success(
+        f"net ${agg.get('net', 0) / 100:+.2f} on ${wagered / 100:.2f} wagered"
+        f" ({agg.get('wins', 0)}W {agg.get('losses', 0)}L {agg.get('pushes', 0)}P)"
+    )
+
+    # true count aggregates are kept for the whole session only
+    if shoe is not None:
+        return
+
+    for tc, agg in ev_by_count(s).items():
+        print(f"TC {tc:+3d}: {agg.get('hands', 0):6d} hands {100 * agg['ev']:+7.2f}% ev")
+
+
+#
+#   Export
+#
+
+
+def iter_ledger(s, chunk=10000):
+    """
+    yields every ledger entry as a dict, reading the stream in chunks.
+    """
+
+    start = "-"
+
+    while True:
+        entries = s.xrange(LOG, min=start, count=chunk)
+
+        for i, fields in entries:
+            yield dict(fields, ts=int(i.split("-")[0]))
+
+        if len(entries) < chunk:
+            return
+
+        start = "(" + entries[-1][0]
+
+
+def export_ledger(s, path, chunk=10000):
+    """
+    writes the ledger to `path` as csv, or as parquet if the path ends in
+    `.parquet` (requires pyarrow).
+
+    :returns: number of entries written
+    """
+
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            logger.error("parquet export requires pyarrow.")
+            return 0
+
+        schema = pa.schema(
+            [(f, pa.string() if f == "kind" else pa.int64()) for f in EXPORT_FIELDS]
+        )
+        n = 0
+
+        with pq.ParquetWriter(path, schema) as writer:
+            rows = []
+
+            for entry in iter_ledger(s, chunk):
+                rows.append(entry)
+
+                if len(rows) == chunk:
+                    writer.write_table(_table(pa, schema, rows))
+                    n += len(rows)
+                    rows = []
+
+            if rows:
+                writer.write_table(_table(pa, schema, rows))
+                n += len(rows)
+
+    else:
+        n = 0
+
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, EXPORT_FIELDS)
+            writer.writeheader()
+
+            for entry in iter_ledger(s, chunk):
+                writer.writerow(entry)
+                n += 1
+
+    logger.success(f"exported {n} ledger entries to {path}.")
+
+    return n
+
+
+def _table(pa, schema, rows):
+    return pa.Table.from_pydict(
+        {
+            f: [r[f] if f == "kind" else int(r[f]) for r in rows]
+            for f in EXPORT_FIELDS
+        },
+        schema=schema,
+    )
@@ -0,0 +1,333 @@
+"""
+phases.py - table status state machine
+
+the layer 1 table status in `status` (see `redis.dbs.md`) moves through a fixed
+set of phases. every transition is checked against `TRANSITIONS` and written by
+one lua script that compares the phase it was validated against, sets the new
+one and appends a `phase` event to the event stream, so concurrent writers can
+never skip a check or interleave. a missing key, or a value outside the phase
+grammar left by older code, reads as `uninit`. `flush_shoe` keeps the key; a new
+shoe moves the table to `staging` and clearing the session to `uninit`, both
+through `transition`.
+
+the same script keeps the players who have stood, busted or got blackjack in
+`status:done`, cleared when a new round starts, and refuses to let any of them
+move again in that round.
+
+components that need to react to a phase change block on the event stream with
+XREAD (`wait_for`, `follow`) instead of polling the key, so they wake up as soon
+as the transition is written; the live dashboard follows the phase this way, and
+the web front end picks it up from the `Command.PHASE` message.
+
+phases
+======
+
+* `uninit`, `staging`, `bets`
+* `dealing_<id>`, `hit_<id>`, `stay_<id>`, `bust_<id>`, `sum_<id>`
+* `player_<id>_move`, `player_<id>_blackjack`
+
+player id 0 is the house.
+"""
+
+import re
+import time
+
+from loguru import logger
+
+from rain import CHANNEL, STREAM, STREAM_MAXLEN, Command
+
+#
+#   Constants
+#
+
+KEY = "status"
+DONE_KEY = "status:done"
+
+UNINIT = "uninit"
+
+BATCH = 256
+BLOCK = 5000  # ms
+
+_PHASE = re.compile(
+    r"^(?:(uninit|staging|bets)|(dealing|hit|stay|bust|sum)_(\d+)|player_(\d+)_(move|blackjack))$"
+)
+
+# phase kind -> kinds it may move to
+TRANSITIONS = {
+    "uninit": {"staging"},
+    "staging": {"bets"},
+    "bets": {"dealing"},
+    "dealing": {"dealing", "move", "blackjack", "sum"},
+    "blackjack": {"blackjack", "move", "sum"},
+    "move": {"hit", "stay"},
+    "hit": {"move", "stay", "bust"},
+    "stay": {"move", "sum"},
+    "bust": {"move", "sum"},
+    "sum": {"sum", "bets", "staging"},
+}
+
+# transitions that stay with the same player
+SAME_PLAYER = {
+    ("move", "hit"),
+    ("move", "stay"),
+    ("hit", "move"),
+    ("hit", "stay"),
+    ("hit", "bust"),
+}
+
+# transitions that hand over to another player
+OTHER_PLAYER = {
+    ("stay", "move"),
+    ("bust", "move"),
+    ("blackjack", "move"),
+}
+
+# kinds after which a player is done for the round
+FINISHED = {"stay", "bust", "blackjack"}
+
+# kinds that start a new round, clearing the finished players
+ROUND_START = {"uninit", "staging", "bets"}
+
+# reachable from any phase: abandoning a round or the table
+RESETS = {"uninit", "staging"}
+
+# KEYS: status, event stream, finished players
+# ARGV: expected phase, new phase, default phase, event stream maxlen, channel,
+#       message, player about to move (or ''), player finishing (or ''),
+#       '1' to start a new round (or '')
+_TRANSITION = """
+local current = redis.call('GET', KEYS[1]) or ARGV[3]
+if current ~= ARGV[1] then
+    return {0, current}
+end
+
+if ARGV[7] ~= '' and redis.call('SISMEMBER', KEYS[3], ARGV[7]) == 1 then
+    return {-1, current}
+end
+
+if ARGV[9] ~= '' then
+    redis.call('DEL', KEYS[3])
+end
+
+if ARGV[8] ~= '' then
+    redis.call('SADD', KEYS[3], ARGV[8])
+end
+
+redis.call('SET', KEYS[1], ARGV[2])
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[4], '*', 'kind', 'phase', 'phase', ARGV[2], 'from', current)
+redis.call('PUBLISH', ARGV[5], ARGV[6])
+
+return {1, current}
+"""
+
+
+def parse_phase(phase):
+    """
+    splits a phase into its kind and player id (None for table-wide phases).
+
+    :raises ValueError: if `phase` is not a phase
+    """
+
+    m = _PHASE.match(phase or "")
+
+    if m is None:
+        raise ValueError(f"unknown phase '{phase}'")
+
+    table, kind, player, move_player, move = m.groups()
+
+    if table:
+        return table, None
+
+    if kind:
+        return kind, int(player)
+
+    return move, int(move_player)
+
+
+def _parse_current(phase):
+    """
+    parses a stored phase, reading anything outside the grammar as `uninit`.
+    """
+
+    try:
+        return parse_phase(phase)
+    except ValueError:
+        return UNINIT, None
+
+
+def allowed(current, phase):
+    """
+    whether the table may move from `current` to `phase`, going by the phase
+    alone (players finished for the round are checked by `transition`).
+    """
+
+    (kind, player), (to_kind, to_player) = _parse_current(current), parse_phase(phase)
+
+    if to_kind in RESETS:
+        return True
+
+    if to_kind not in TRANSITIONS[kind]:
+        return False
+
+    if (kind, to_kind) in SAME_PLAYER:
+        return player == to_player
+
+    if (kind, to_kind) in OTHER_PLAYER:
+        return player != to_player
+
+    return True
+
+
+def normalize_phase(phase):
+    """
+    `phase`, or `uninit` if it is missing or outside the phase grammar.
+    """
+
+    try:
+        parse_phase(phase)
+    except ValueError:
+        return UNINIT
+
+    return phase
+
+
+def get_phase(s):
+    return normalize_phase(s.get(KEY))
+
+
+def transition(s, phase, expected=None):
+    """
+    moves the table to `phase`. with `expected`, the move only happens if the
+    table is still in that phase; otherwise a concurrent change is revalidated
+    and retried.
+
+    :returns: the new phase, or None if the transition is not allowed
+    """
+
+    try:
+        for p in (phase, expected):
+            if p is not None:
+                parse_phase(p)
+    except ValueError as e:
+        logger.warning(f"{e}.")
+        s.publish(CHANNEL, f"ERR:Could not move to {phase}: {e}.")
+        return None
+
+    to_kind, player = parse_phase(phase)
+    player = "" if player is None else str(player)
+
+    script = s.register_script(_TRANSITION)
+
+    while True:
+        # compare against the raw stored value, so one left by older code can
+        # still be replaced
+        current = expected or s.get(KEY) or UNINIT
+
+        if not allowed(current, phase):
+            logger.warning(f"cannot move from {current} to {phase}.")
+            s.publish(CHANNEL, f"ERR:Could not move from {current} to {phase}.")
+            return None
+
+        ok, actual = script(
+            keys=[KEY, STREAM, DONE_KEY],
+            args=[
+                current,
+                phase,
+                UNINIT,
+                STREAM_MAXLEN,
+                CHANNEL,
+                f"{Command.PHASE} {phase}",
+                player if to_kind == "move" else "",
+                player if to_kind in FINISHED else "",
+                "1" if to_kind in ROUND_START else "",
+            ],
+        )
+
+        if ok == 1:
+            logger.info(f"phase {current} -> {phase}")
+            return phase
+
+        if ok == -1:
+            logger.warning(f"player {player} is done for this round.")
+            s.publish(CHANNEL, f"ERR:Could not move to {phase}: player {player} is done.")
+            return None
+
+        if expected is not None:
+            logger.warning(f"expected phase {expected}, table is in {actual}.")
+            return None
+
+
+def _matches(phase, targets):
+    kind, _ = _parse_current(phase)
+    return phase in targets or kind in targets
+
+
+def _position(s):
+    """
+    the current phase and the id of the last event, read atomically so no
+    transition falls between them.
+    """
+
+    pipe = s.pipeline()
+    pipe.get(KEY)
+    pipe.xrevrange(STREAM, count=1)
+    phase, last = pipe.execute()
+
+    return normalize_phase(phase), last[0][0] if last else "0-0"
+
+
+def follow(s, block=BLOCK):
+    """
+    yields the current phase, then every phase the table moves to, blocking on
+    the event stream in between.
+    """
+
+    phase, last_id = _position(s)
+    yield phase
+
+    while True:
+        reply = s.xread({STREAM: last_id}, count=BATCH, block=block)
+
+        for event_id, fields in reply[0][1] if reply else []:
+            last_id = event_id
+
+            if fields.get("kind") == "phase":
+                yield fields["phase"]
+
+
+def wait_for(s, *targets, timeout=None):
+    """
+    blocks until the table is in one of `targets`, each a phase (`bets`,
+    `hit_2`) or a kind matching any player (`move`, `bust`).
+
+    :param timeout: seconds to wait, or None to wait forever
+    :returns: the matching phase, or None on timeout
+    """
+
+    phase, last_id = _position(s)
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    while not _matches(phase, targets):
+        if deadline is None:
+            block = 0
+        else:
+            block = int((deadline - time.monotonic()) * 1000)
+
+            if block <= 0:
+                return None
+
+        reply = s.xread({STREAM: last_id}, count=BATCH, block=block)
+
+        if not reply:
+            continue
+
+        for event_id, fields in reply[0][1]:
+            last_id = event_id
+
+            if fields.get("kind") == "phase":
+                phase = fields["phase"]
+
+                if _matches(phase, targets):
+                    break
+
+    return phase
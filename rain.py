@@ -3,13 +3,14 @@
 import random
 import os
 import time
-import redis
 import esper
+from array import array
 from enum import Enum
 from loguru import logger
-from collections import namedtuple
 import uuid
 
+from asrm import DatabaseIface
+
 
 def generate_session_token(s):
     """
@@ -35,6 +36,17 @@ C_ALL = POS + NUL + NEG
 
 CHANNEL = "rainman"
 
+# capped event stream mirroring card, status, phase and fund events for consumer
+# groups
+STREAM = "sys:events"
+STREAM_MAXLEN = 100000
+
+# keys that outlive a shoe: the bankroll, the bet ledger, the event stream (its
+# consumer groups must survive a new shoe, and MAXLEN already bounds it), the
+# session statistics and the table phase, which only changes by a transition
+PERSISTENT_KEYS = ["funds", "buyin", STREAM, "status"]
+PERSISTENT_PREFIXES = ("ledger:", "stats:")
+
 #
 #   Default Configuration
 #
@@ -84,10 +96,22 @@ class Rank(Enum):
     ACE = 12
 
 
+def emit(s, kind, **fields):
+    """
+    appends an event to the capped event stream. `s` may be a pipeline, so the
+    event goes out in the same round trip as the change it records.
+    """
+
+    s.xadd(STREAM, dict(fields, kind=kind), maxlen=STREAM_MAXLEN, approximate=True)
+
+
 def change_status(s, stat):
     logger.info("Status changed to " + stat.name)
-    s.set("sys:status", "Status." + stat.name)
-    s.publish(CHANNEL, "Status." + stat.name)
+    pipe = s.pipeline()
+    pipe.set("sys:status", "Status." + stat.name)
+    pipe.publish(CHANNEL, "Status." + stat.name)
+    emit(pipe, "status", status=stat.name)
+    pipe.execute()
     return stat
 
 
@@ -103,7 +127,7 @@ def get_redis_session(host=None, port=None, db=None):
     port = port or _default_config["red_port"]
     db = db or _default_config["red_db"]
 
-    return redis.StrictRedis(host=host, port=port, db=db, charset="utf-8", decode_responses=True)
+    return DatabaseIface({"host": host, "port": int(port), "db": db}).db
 
 
 def clear_session(s, flushall=False):
@@ -123,11 +147,35 @@ def clear_session(s, flushall=False):
 
     change_status(s, Status.NONE)
 
+    # announce the table phase the flush left behind
+    from phases import UNINIT, transition
+
+    transition(s, UNINIT)
+
     logger.success("cleared session and flushed db.")
 
     return True
 
 
+def flush_shoe(s, pipe=None):
+    """
+    deletes every key of the current shoe, keeping the bankroll, the ledger,
+    the event stream and the statistics. with `pipe`, the deletes are queued on
+    it, so a transaction can flush and reload the shoe in one step.
+    """
+
+    keys = [
+        k
+        for k in s.scan_iter(count=1000)
+        if k not in PERSISTENT_KEYS and not k.startswith(PERSISTENT_PREFIXES)
+    ]
+
+    target = pipe if pipe is not None else s
+
+    for i in range(0, len(keys), 1000):
+        target.delete(*keys[i:i + 1000])
+
+
 def session_status(s, reinit=True):
     """
     Checks to see if there is a current session in the DB, and potentially
@@ -136,15 +184,12 @@ def session_status(s, reinit=True):
 
     logger.info("checking session status.")
 
-    s_exists = bool(s.exists("status"))  # TODO: Potential redundancy
+    status = s.get("sys:status")
 
-    if s_exists:
-        # Returns a status indicator
-        return s.get("status")
+    if status:
+        return Status[status.split(".")[-1]]
 
-    else:
-        result = change_status(s, Status.NONE)
-        return result
+    return change_status(s, Status.NONE) if reinit else Status.NONE
 
 
 def init_session(s, decks=None, splits=None, shuffles=None):
@@ -154,9 +199,9 @@ def init_session(s, decks=None, splits=None, shuffles=None):
 
     decks = decks or _default_config["decks"]
 
-    s.flushdb()
-    s.set("status", "init")
-    s.publish(CHANNEL, "Status.INIT")
+    flush_shoe(s)
+    s.incr("ledger:shoe")
+    change_status(s, Status.INIT)
 
     logger.info("initializing session.")
 
@@ -177,9 +222,8 @@ def init_session(s, decks=None, splits=None, shuffles=None):
     logger.info("creating valuation data points for each card.")
     s.publish(CHANNEL, "calc_valuations")
 
-    for card in deck.cards:
-        key = "card:value:" + card.rank
-        s.set(key, card.value)
+    for name in RANK_NAMES:
+        s.set(VALUE_KEYS[RANK_INDEX[name]], card_value(name))
 
     # ranks
     logger.info("storing rank information.")
@@ -199,7 +243,7 @@ def init_session(s, decks=None, splits=None, shuffles=None):
     logger.info("setting configuration variables.")
     s.publish(CHANNEL, "set_config_vars")
 
-    s.set("decks", _default_config["decks"])
+    s.set("decks", decks)
     s.set("shuffles", _default_config["shuffles"])
     s.set("splits", _default_config["splits"])
 
@@ -217,17 +261,13 @@ def init_session(s, decks=None, splits=None, shuffles=None):
     s.set("left", left)
     s.publish(CHANNEL, f"Command.DECKS {decks}")
     s.set("run", 0)
+    emit(s, "shoe", cards=left, decks=decks)
 
-    for rank in deck.ranks:
-        s.incrby("shoe:" + rank, decks * 4)
-
-    for d in range(decks):
-        for i in range(4):
-            for rank in deck.ranks:
-                s.lpush("sim:shoe", str(rank))
+    s.mset({key: decks * 4 for key in SHOE_KEYS})
+    s.lpush("sim:shoe", *[RANK_NAMES[card_rank(card)] for card in shoe])
 
-    s.set("funds", 0)
-    s.set("buyin", 500)
+    s.setnx("funds", 0)
+    s.setnx("buyin", 500)
 
     # outputting total for each card
     # logger.info("number of cards for each rank:")
@@ -237,9 +277,13 @@ def init_session(s, decks=None, splits=None, shuffles=None):
     #     print(f"  {card:3s}: {count}")
     card_counts(s)
 
+    # a new shoe puts the table back into staging, announced like any other
+    # phase change
+    from phases import transition
+
+    transition(s, "staging")
+
     change_status(s, Status.ACTIVE)
-    # s.set(":status", Status.ACTIVE.value)
-    # s.publish(CHANNEL, Status.ACTIVE.value)
 
 
 #
@@ -264,10 +308,60 @@ def card_value(rank=None):
         return 0.0
 
 
+#
+#   Integer card encoding
+#
+#   a card is a small int: its rank (the `Rank` value, 0-12, in `C_ALL` order) in
+#   the low four bits and an optional suit (0-3) in the next two. rank strings are
+#   parsed once, at the input boundary; everything past it indexes the lookup
+#   tables below.
+#
+
+RANK_NAMES = C_ALL
+RANK_INDEX = {name: rank for rank, name in enumerate(RANK_NAMES)}
+
+SHOE_KEYS = ["shoe:" + name for name in RANK_NAMES]
+VALUE_KEYS = ["card:value:" + name for name in RANK_NAMES]
+TAGS = [int(card_value(name)) for name in RANK_NAMES]
+
+
+def parse_rank(rank):
+    """
+    turns a rank string (or int, or `Rank`) into its rank int.
+
+    :returns: the rank int, or None if it is not a rank
+    """
+
+    if isinstance(rank, Rank):
+        return rank.value
+
+    if isinstance(rank, int):
+        return rank if 0 <= rank < len(RANK_NAMES) else None
+
+    if isinstance(rank, str):
+        return RANK_INDEX.get(rank.strip().upper())
+
+    return None
+
+
+def encode_card(rank, suit=0):
+    return rank | suit << 4
+
+
+def card_rank(card):
+    return card & 0xF
+
+
+def card_suit(card):
+    return card >> 4
+
+
 def card_count(s, rank=None):
-    if rank in C_ALL:
-        count = int(s.get("shoe:" + rank))
-        s.publish(CHANNEL, f"Cn,{rank}:{count}")
+    rank = parse_rank(rank)
+
+    if rank is not None:
+        count = int(s.get(SHOE_KEYS[rank]))
+        s.publish(CHANNEL, f"Cn,{RANK_NAMES[rank]}:{count}")
         return count
 
     return "count not available"
@@ -277,18 +371,13 @@ def card_counts(s):
     # outputting total for each card
     logger.info("Number of cards for each rank:")
 
-    for card in C_ALL:
-        try:
-            count = int(s.get("shoe:" + card))
-            total = int(s.get("left"))
-        except TypeError:
-            count = 0
-            total = 0
+    *counts, total = (int(v or 0) for v in s.mget(SHOE_KEYS + ["left"]))
 
+    for name, count in zip(RANK_NAMES, counts):
         try:
-            print(f"{card:3s}: {count} ({100 * count / total:.2f}%)")
+            print(f"{name:3s}: {count} ({100 * count / total:.2f}%)")
         except ZeroDivisionError:
-            print(f"{card:3s}: {count} ({0}%)")
+            print(f"{name:3s}: {count} ({0}%)")
 
 
 def shoe_length(s):
@@ -346,9 +435,12 @@ def withdraw_funds(s, amount):
     amount *= 100
     amount = int(amount)
 
-    s.decrby("::funds", amount)
+    pipe = s.pipeline()
+    pipe.decrby("funds", amount)
+    pipe.publish(CHANNEL, f"{Command.FUNDS} ADD {amount / 100:.2f}")
+    emit(pipe, "funds", amount=-amount)
+    pipe.execute()
     logger.info(f"withdrew ${amount / 100:.2f} from funds.")
-    s.publish(CHANNEL, f"{Command.FUNDS} ADD {amount / 100:.2f}")
 
 
 def add_funds(s, amount):
@@ -356,9 +448,12 @@ def add_funds(s, amount):
     amount *= 100
     amount = int(amount)
 
-    s.incrby("funds", amount)
+    pipe = s.pipeline()
+    pipe.incrby("funds", amount)
+    pipe.publish(CHANNEL, f"{Command.FUNDS} ADD {amount / 100:.2f}")
+    emit(pipe, "funds", amount=amount)
+    pipe.execute()
     logger.info(f"added ${amount / 100:.2f} to funds.")
-    s.publish(CHANNEL, f"{Command.FUNDS} ADD {amount / 100:.2f}")
 
 
 def get_funds(s):
@@ -386,12 +481,21 @@ def set_buyin(s, buyin):
 
 
 def clean_rank(func):
-    def wrapper(*args, **kwargs):
-        try:
-            kwargs["rank"] = kwargs["rank"].upper().strip()
-        except AttributeError:
-            logger.error("No rank found.")
-        return func(*args, **kwargs)
+    """
+    parses the `rank` keyword into a rank int before the call; unknown ranks are
+    reported and the call is skipped.
+    """
+
+    def wrapper(s, *args, **kwargs):
+        rank = parse_rank(kwargs.get("rank"))
+
+        if rank is None:
+            logger.warning(f"card {kwargs.get('rank')} does not exist.")
+            s.publish(CHANNEL, f"ERR:Could not {func.__name__.split('_')[0]} {kwargs.get('rank')}.")
+            return None
+
+        kwargs["rank"] = rank
+        return func(s, *args, **kwargs)
 
     return wrapper
 
@@ -402,17 +506,17 @@ def remove_card(s, rank=None, n=1):
     remove a deck from the deck.
     """
 
-    if rank in C_ALL:
-        shoe = s.decrby("shoe:" + rank, n)
-        left = s.decrby("left", n)
-        s.incrby("run", int(card_value(rank) * n))
-        s.publish(CHANNEL, f"{Command.REMOVE} {rank}")
-        logger.success(f"removed {rank} from the deck.")
-        return rank
+    name = RANK_NAMES[rank]
 
-    else:
-        logger.warning(f"card {rank} does not exist.")
-        s.publish(CHANNEL, f"ERR:Could not remove {rank} from shoe.")
+    pipe = s.pipeline()
+    pipe.decrby(SHOE_KEYS[rank], n)
+    pipe.decrby("left", n)
+    pipe.incrby("run", TAGS[rank] * n)
+    pipe.publish(CHANNEL, f"{Command.REMOVE} {name}")
+    emit(pipe, "remove", rank=name, n=n)
+    pipe.execute()
+    logger.success(f"removed {name} from the deck.")
+    return rank
 
 
 @clean_rank
@@ -421,40 +525,81 @@ def replace_card(s, rank=None, n=1):
     put a card back into the deck.
     """
 
-    if rank in C_ALL:
-        shoe = s.incrby("shoe:" + rank, n)
-        left = s.incrby("left", n)
-        # s.incrby("::run", int(card_value(rank) * n))
-        s.decrby("run", int(card_value(rank) * n))
-        s.publish(CHANNEL, f"{Command.REPLACE} {rank}")
-        logger.success(f"replaced {rank} into the deck.")
+    name = RANK_NAMES[rank]
 
-    else:
-        logger.warning(f"card {rank} does not exist.")
-        s.publish(CHANNEL, f"ERR:Could not replace {rank} into shoe.")
+    pipe = s.pipeline()
+    pipe.incrby(SHOE_KEYS[rank], n)
+    pipe.incrby("left", n)
+    pipe.decrby("run", TAGS[rank] * n)
+    pipe.publish(CHANNEL, f"{Command.REPLACE} {name}")
+    emit(pipe, "replace", rank=name, n=n)
+    pipe.execute()
+    logger.success(f"replaced {name} into the deck.")
+    return rank
+
+
+def update_cards(s, ops, history=True):
+    """
+    removes and replaces a batch of cards in one round trip.
+
+    :param ops: list of (rank int, n); n > 0 removes n cards, n < 0 puts them back
+    :returns: (dict of the new count of each touched rank, left, run), with left
+        and run None if nothing was applied
+    """
+
+    pipe = s.pipeline()
+    applied = []
+
+    for rank, n in ops:
+        name = RANK_NAMES[rank]
+        command = Command.REMOVE if n > 0 else Command.REPLACE
+
+        pipe.decrby(SHOE_KEYS[rank], n)
+        pipe.decrby("left", n)
+        pipe.incrby("run", TAGS[rank] * n)
+        pipe.publish(CHANNEL, f"{command} {name}")
+        emit(pipe, "remove" if n > 0 else "replace", rank=name, n=abs(n))
+
+        if history and n > 0:
+            pipe.lpush("history", *[name] * n)
+
+        applied.append((rank, n))
+
+    if not applied:
+        return {}, None, None
+
+    results = pipe.execute()
+
+    counts = {}
+    i = 0
+    for rank, n in applied:
+        counts[rank], left, run = results[i:i + 3]
+        i += 5 + (history and n > 0)
+
+    return counts, left, run
 
 
 #
 #   Classes and important contexts
 #
 
-Card = namedtuple("Card", "rank suit value")
-
-
 class FrenchDeck:
     """
-    Simple, functioning french deck
+    Simple, functioning french deck, held as an array of encoded cards
     """
 
     ranks = [str(r) for r in range(2, 11)] + list("JQKA")
     suits = "hearts diamonds clubs spades".split()
 
     def __init__(self):
-        self.cards = [
-            Card(rank, suit, card_value(rank))
-            for suit in self.suits
-            for rank in self.ranks
-        ]
+        self.cards = array(
+            "B",
+            (
+                encode_card(rank, suit)
+                for suit in range(len(self.suits))
+                for rank in range(len(self.ranks))
+            ),
+        )
 
 
 class Command(Enum):
@@ -471,3 +616,4 @@ class Command(Enum):
     WIN = 11  # signify a win
     LOSS = 12  # loss
     REPL = 13  # read, eval, prompt, loop
+    PHASE = 14  # table phase changed
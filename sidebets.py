@@ -0,0 +1,273 @@
+"""
+sidebets.py - insurance and side bet ev from the exact shoe composition
+
+keeps the combinatorial terms needed to price insurance, Perfect Pairs, 21+3 and
+Lucky Ladies from the per-rank counts in `shoe:<rank>`. each card removed or put
+back updates the terms in O(1), and each bet's ev is then O(1) to read.
+
+`run_worker` keeps one `SideBets` alive next to the session: it follows the card
+events on the event stream, applies each to the terms, and writes the evs with
+the id of the last event applied to `sidebets:evs`. `get_evs` reads them from
+there while they are current, and rebuilds from the shoe counts otherwise.
+
+the shoe only tracks ranks, so each rank's cards are assumed to be spread evenly
+over the four suits (n / 4 per suit).
+
+paytables
+=========
+
+* insurance: 2:1
+* perfect pairs: mixed 6:1, colored 12:1, perfect 25:1
+* 21+3: flush 5:1, straight 10:1, three of a kind 30:1, straight flush 40:1,
+  suited trips 100:1
+* lucky ladies: any 20 4:1, suited 20 9:1, matched 20 19:1, queen of hearts
+  pair 200:1 (the 1000:1 bonus against a dealer blackjack is not priced)
+"""
+
+import redis
+from loguru import logger
+
+from rain import RANK_INDEX, RANK_NAMES, SHOE_KEYS, STREAM, parse_rank
+
+#
+#   Constants
+#
+
+EVS_KEY = "sidebets:evs"
+
+BATCH = 256
+BLOCK = 5000  # ms
+
+TENS = [RANK_INDEX[r] for r in ("10", "J", "Q", "K")]
+NINE = RANK_INDEX["9"]
+ACE = RANK_INDEX["A"]
+QUEEN = RANK_INDEX["Q"]
+
+# three-card straights over rank indices, ace low and high
+STRAIGHTS = [(ACE, 0, 1)] + [(i, i + 1, i + 2) for i in range(len(RANK_NAMES) - 2)]
+
+# straights each rank takes part in
+_STRAIGHTS_OF = {
+    r: [tuple(x for x in st if x != r) for st in STRAIGHTS if r in st]
+    for r in range(len(RANK_NAMES))
+}
+
+PERFECT_PAIRS = {"mixed": 6, "colored": 12, "perfect": 25}
+TWENTY_ONE_THREE = {
+    "flush": 5,
+    "straight": 10,
+    "trips": 30,
+    "straight_flush": 40,
+    "suited_trips": 100,
+}
+LUCKY_LADIES = {"any": 4, "suited": 9, "matched": 19, "queens": 200}
+
+
+def _ev(pays, probs):
+    """
+    ev per unit of a bet paying `pays[k]` to one with probability `probs[k]`,
+    losing otherwise.
+    """
+
+    return sum((pays[k] + 1) * p for k, p in probs.items()) - 1
+
+
+class SideBets:
+    """
+    incremental shoe composition terms and the side bet evs built on them.
+    """
+
+    def __init__(self, counts):
+        """
+        :param counts: remaining count of each rank, indexed by rank int
+        """
+
+        self.n = list(counts)
+        self.total = sum(self.n)
+        self.s2 = sum(c * c for c in self.n)
+        self.s3 = sum(c ** 3 for c in self.n)
+        self.tens = sum(self.n[r] for r in TENS)
+        self.tens_s2 = sum(self.n[r] ** 2 for r in TENS)
+        self.straights = sum(self.n[a] * self.n[b] * self.n[c] for a, b, c in STRAIGHTS)
+
+    @classmethod
+    def from_session(cls, s):
+        return cls(int(c or 0) for c in s.mget(SHOE_KEYS))
+
+    def update(self, rank, n=1):
+        """
+        removes `n` cards of `rank` (put back if `n` is negative).
+        """
+
+        r = parse_rank(rank)
+        step = -1 if n > 0 else 1
+
+        for _ in range(abs(n)):
+            c = self.n[r]
+            d = c + step
+
+            self.straights += step * sum(self.n[a] * self.n[b] for a, b in _STRAIGHTS_OF[r])
+            self.s2 += d * d - c * c
+            self.s3 += d ** 3 - c ** 3
+
+            if r in TENS:
+                self.tens += step
+                self.tens_s2 += d * d - c * c
+
+            self.n[r] = d
+            self.total += step
+
+    #
+    #   Bets
+    #
+
+    def insurance(self):
+        """
+        ev of insurance, with the dealer's ace already out of the shoe.
+        """
+
+        if not self.total:
+            return 0.0
+
+        return (3 * self.tens - self.total) / self.total
+
+    def perfect_pairs_probs(self):
+        pairs = self.total * (self.total - 1)
+
+        if not pairs:
+            return {k: 0.0 for k in PERFECT_PAIRS}
+
+        s1 = self.total
+        return {
+            "perfect": (self.s2 - 4 * s1) / 4 / pairs,
+            "colored": self.s2 / 4 / pairs,
+            "mixed": self.s2 / 2 / pairs,
+        }
+
+    def perfect_pairs(self):
+        return _ev(PERFECT_PAIRS, self.perfect_pairs_probs())
+
+    def twenty_one_three_probs(self):
+        n = self.total
+        hands = n * (n - 1) * (n - 2)
+
+        if not hands:
+            return {k: 0.0 for k in TWENTY_ONE_THREE}
+
+        s1, s2, s3 = n, self.s2, self.s3
+
+        # ordered three-card draws; suited terms take n / 4 of a rank per suit
+        trips = s3 - 3 * s2 + 2 * s1
+        suited_trips = s3 / 16 - 3 * s2 / 4 + 2 * s1
+        straight_flush = 6 * self.straights / 16
+        straight = 6 * self.straights - straight_flush
+        flush = n * (n / 4 - 1) * (n / 4 - 2) - suited_trips - straight_flush
+
+        return {
+            "suited_trips": suited_trips / hands,
+            "straight_flush": straight_flush / hands,
+            "trips": (trips - suited_trips) / hands,
+            "straight": straight / hands,
+            "flush": flush / hands,
+        }
+
+    def twenty_one_three(self):
+        return _ev(TWENTY_ONE_THREE, self.twenty_one_three_probs())
+
+    def lucky_ladies_probs(self):
+        pairs = self.total * (self.total - 1)
+
+        if not pairs:
+            return {k: 0.0 for k in LUCKY_LADIES}
+
+        t, aces, nines, queens = self.tens, self.n[ACE], self.n[NINE], self.n[QUEEN]
+
+        queen_pair = (queens / 4) * (queens / 4 - 1)
+        matched = (self.tens_s2 - 4 * t) / 4 - queen_pair
+        suited = t * (t - 4) / 4 - matched - queen_pair + aces * nines / 2
+        any20 = t * (t - 1) + 2 * aces * nines - suited - matched - queen_pair
+
+        return {
+            "queens": queen_pair / pairs,
+            "matched": matched / pairs,
+            "suited": suited / pairs,
+            "any": any20 / pairs,
+        }
+
+    def lucky_ladies(self):
+        return _ev(LUCKY_LADIES, self.lucky_ladies_probs())
+
+    def evs(self):
+        return {
+            "insurance": self.insurance(),
+            "perfect pairs": self.perfect_pairs(),
+            "21+3": self.twenty_one_three(),
+            "lucky ladies": self.lucky_ladies(),
+        }
+
+
+def _position(s):
+    """
+    the shoe counts and the id of the last event, read atomically so no card
+    falls between them.
+    """
+
+    pipe = s.pipeline()
+    pipe.mget(SHOE_KEYS)
+    pipe.xrevrange(STREAM, count=1)
+    counts, last = pipe.execute()
+
+    return SideBets(int(c or 0) for c in counts), last[0][0] if last else "0-0"
+
+
+def get_evs(s):
+    """
+    the side bet evs, from the worker if it is up to date with the event
+    stream, otherwise from the shoe counts.
+    """
+
+    pipe = s.pipeline()
+    pipe.hgetall(EVS_KEY)
+    pipe.xrevrange(STREAM, count=1)
+    evs, last = pipe.execute()
+
+    if evs and last and evs.pop("id", None) == last[0][0]:
+        return {bet: float(ev) for bet, ev in evs.items()}
+
+    return SideBets.from_session(s).evs()
+
+
+def run_worker(s, block=BLOCK):
+    """
+    follows the card events forever, keeping the side bet evs in `EVS_KEY`.
+    """
+
+    bets, last_id = _position(s)
+    logger.info(f"side bet worker starting after event {last_id}.")
+
+    while True:
+        s.hset(EVS_KEY, mapping={**bets.evs(), "id": last_id})
+
+        try:
+            reply = s.xread({STREAM: last_id}, count=BATCH, block=block)
+        except redis.ResponseError as e:
+            if "UNBLOCKED" not in str(e):
+                raise
+
+            # the stream was deleted while we were blocked on it
+            bets, last_id = _position(s)
+            continue
+
+        for event_id, fields in reply[0][1] if reply else []:
+            last_id = event_id
+            kind = fields.get("kind")
+
+            if kind in ("remove", "replace"):
+                n = int(fields.get("n", 1))
+                bets.update(fields["rank"], n if kind == "remove" else -n)
+
+            elif kind == "shoe":
+                # a new or restored shoe; the rest of this batch is already
+                # in the counts read back
+                bets, last_id = _position(s)
+                break
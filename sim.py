@@ -0,0 +1,377 @@
+"""
+sim.py - headless blackjack simulation farm
+
+plays rounds of hi-lo counted, basic strategy blackjack with no redis involved.
+a run is cut into a fixed number of shards, each with its own independent stream
+spawned from one numpy SeedSequence, so a run is exactly reproducible from its
+seed no matter how many worker processes play the shards. per-shard statistics
+are kept in mergeable accumulators and merged back in shard order.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from loguru import logger
+
+from accumulators import TC_MAX, TC_MIN, Accumulator, tc_bucket
+from charts import DEFAULT_RULES, LABELS, MAX_HANDS, add_card, load_chart
+from rain import RANK_INDEX, TAGS
+
+
+def value_tags(tags):
+    """
+    re-indexes per-rank tags (indexed by rank int) by card value (2-11), as
+    `Shoe` deals values: ranks 2-9 are their own value, ten to king are 10 and
+    the ace is 11.
+    """
+
+    ten, ace = RANK_INDEX["10"], RANK_INDEX["A"]
+    return [0, 0] + list(tags[:ten]) + [tags[ten], tags[ace]]
+
+
+#
+#   Constants
+#
+
+# hi-lo tag of each card value, indexed by value (2-11)
+HILO = value_tags(TAGS)
+
+DEFAULT_SHARDS = 64
+DEFAULT_PENETRATION = 0.75
+
+# cards always left behind the cut card, so a round started before the cut never
+# runs off the end of the shoe
+RESERVE = 20
+DEFAULT_SPREAD = 8
+SAMPLE_EVERY = 1000
+
+
+def bet_units(tc, spread=DEFAULT_SPREAD):
+    """
+    the default bet ramp: one unit at or below a true count of 1, then one more
+    unit per true count, capped at the spread.
+    """
+
+    return max(1, min(spread, int(tc)))
+
+
+#
+#   Statistics
+#
+
+
+class SimStats:
+    """
+    statistics for a shard, or for many merged shards, of a simulation.
+
+    all money is in betting units.
+    """
+
+    def __init__(self):
+        self.rounds = 0
+        self.wagered = 0.0
+        self.bankroll = 0.0
+        self.net = Accumulator()
+        self.tc = [Accumulator() for _ in range(TC_MIN, TC_MAX + 1)]
+        self.path = []
+
+    def add(self, tc, bet, result):
+        """
+        records a round of `bet` units; `result` is per unit bet, which is what
+        the true count buckets accumulate.
+        """
+
+        net = bet * result
+
+        self.rounds += 1
+        self.wagered += bet
+        self.bankroll += net
+        self.net.add(net)
+        self.tc[tc_bucket(tc) - TC_MIN].add(result)
+
+    def sample(self):
+        self.path.append(self.bankroll)
+
+    def merge(self, other):
+        """
+        appends another shard's results, continuing its bankroll path from ours.
+        """
+
+        self.path.extend(self.bankroll + b for b in other.path)
+        self.rounds += other.rounds
+        self.wagered += other.wagered
+        self.bankroll += other.bankroll
+        self.net.merge(other.net)
+
+        for mine, theirs in zip(self.tc, other.tc):
+            mine.merge(theirs)
+
+        return self
+
+    @property
+    def ev(self):
+        """
+        net result per unit wagered.
+        """
+
+        return self.bankroll / self.wagered if self.wagered else 0.0
+
+    def tc_histogram(self):
+        return {tc: acc.n for tc, acc in zip(range(TC_MIN, TC_MAX + 1), self.tc)}
+
+    def report(self):
+        logger.info(f"rounds: {self.rounds}")
+        logger.info(f"wagered: {self.wagered:.0f} units")
+        logger.success(f"result: {self.bankroll:+.1f} units ({100 * self.ev:+.3f}% ev)")
+        logger.info(f"per round: {self.net.mean:+.4f} units, sd {self.net.variance ** 0.5:.4f}")
+
+        for tc, acc in zip(range(TC_MIN, TC_MAX + 1), self.tc):
+            if acc.n:
+                print(f"TC {tc:+3d}: {acc.n:10d} rounds, {acc.mean:+.4f} ev per unit bet")
+
+
+#
+#   The game
+#
+
+
+class Shoe:
+    """
+    a shuffled shoe of card values, keeping the running count of what has been
+    dealt (hi-lo unless other `tags`, indexed by value, are given).
+
+    the cut card sits at `penetration`, but never less than `RESERVE` cards from
+    the end. should a round still use up the shoe, it is reshuffled mid-round.
+    """
+
+    __slots__ = ("rng", "base", "cut", "cards", "pos", "run", "tags", "scale")
+
+    def __init__(self, rng, decks, penetration, tags=HILO, scale=1):
+        if not 0 < penetration < 1:
+            raise ValueError(f"penetration must be between 0 and 1, not {penetration}")
+
+        self.rng = rng
+        self.base = np.array([v for v in range(2, 12) for _ in range(16 if v == 10 else 4)] * decks)
+        self.cut = max(1, min(int(len(self.base) * penetration), len(self.base) - RESERVE))
+        self.tags = tags
+        self.scale = scale
+        self.shuffle()
+
+    def shuffle(self):
+        self.cards = self.rng.permutation(self.base).tolist()
+        self.pos = 0
+        self.run = 0
+
+    def draw(self):
+        if self.pos == len(self.cards):
+            self.shuffle()
+
+        card = self.cards[self.pos]
+        self.pos += 1
+        self.run += self.tags[card]
+        return card
+
+    @property
+    def true_count(self):
+        left = len(self.cards) - self.pos
+        return self.run / self.scale / (left / 52) if left else 0.0
+
+    @property
+    def penetration(self):
+        return self.pos / len(self.cards)
+
+
+class Strategy:
+    """
+    basic strategy chart flattened into int-keyed lookups.
+    """
+
+    def __init__(self, chart):
+        labels = {label: v for v, label in zip(range(2, 12), LABELS)}
+
+        def table(name, key):
+            return {
+                (key(row), labels[up]): code
+                for row, cols in chart[name].items()
+                for up, code in cols.items()
+            }
+
+        self.hard = table("hard", int)
+        self.soft = table("soft", int)
+        self.pairs = table("pairs", lambda r: labels[r])
+
+    def decide(self, total, soft, up, pair, can_double, can_surrender, can_split):
+        if pair and can_split:
+            code = self.pairs[(pair, up)]
+
+            if code == "P" or (code == "Rp" and not can_surrender):
+                return "P"
+
+        elif soft:
+            code = "H" if total < 13 else "S" if total > 20 else self.soft[(total, up)]
+
+        else:
+            code = self.hard[(max(5, total), up)] if total < 21 else "S"
+
+        if code[0] == "D":
+            return "D" if can_double else code[1].upper()
+
+        if code[0] == "R":
+            return "R" if can_surrender else code[1].upper()
+
+        return code
+
+
+def play_round(shoe, strategy, rules):
+    """
+    plays one round heads up against the dealer.
+
+    :returns: net result of the round in multiples of the initial bet
+    """
+
+    draw = shoe.draw
+    first, up, second, hole = draw(), draw(), draw(), draw()
+
+    player = add_card(*add_card(0, False, first), second)
+    dealer = add_card(*add_card(0, False, up), hole)
+
+    if player[0] == 21 or dealer[0] == 21:
+        if player[0] == dealer[0]:
+            return 0.0
+        return 1.5 if player[0] == 21 else -1.0
+
+    hands = [(first, second, False)]
+    finished = []
+    splits = 1
+
+    while hands:
+        a, b, split = hands.pop()
+        total, soft = add_card(*add_card(0, False, a), b)
+        mult = 1.0
+
+        if split and a == 11:
+            # split aces get one card each
+            finished.append((total, mult))
+            continue
+
+        cards = 2
+
+        while total < 21:
+            action = strategy.decide(
+                total,
+                soft,
+                up,
+                a if cards == 2 and a == b else None,
+                cards == 2 and (rules.das or not split),
+                cards == 2 and not split and rules.surrender,
+                splits < MAX_HANDS and (not split or rules.resplit),
+            )
+
+            if action == "S":
+                break
+
+            if action == "R":
+                return -0.5
+
+            if action == "P":
+                splits += 1
+                hands.append((a, draw(), True))
+                hands.append((a, draw(), True))
+                total = None
+                break
+
+            total, soft = add_card(total, soft, draw())
+            cards += 1
+
+            if action == "D":
+                mult = 2.0
+                break
+
+        if total is not None:
+            finished.append((total, mult))
+
+    if all(total > 21 for total, _ in finished):
+        return -sum(mult for _, mult in finished)
+
+    total, soft = dealer
+    while total < 17 or (rules.h17 and soft and total == 17):
+        total, soft = add_card(total, soft, draw())
+
+    net = 0.0
+    for hand, mult in finished:
+        if hand > 21 or (total <= 21 and hand < total):
+            net -= mult
+        elif total > 21 or hand > total:
+            net += mult
+
+    return net
+
+
+def run_shard(seed, rounds, rules, chart, penetration, spread, sample_every):
+    """
+    plays `rounds` rounds on one independent stream.
+    """
+
+    rng = np.random.default_rng(seed)
+    shoe = Shoe(rng, rules.decks, penetration)
+    strategy = Strategy(chart)
+    stats = SimStats()
+
+    for i in range(rounds):
+        if shoe.pos >= shoe.cut:
+            shoe.shuffle()
+
+        tc = shoe.true_count
+        bet = bet_units(tc, spread)
+        stats.add(tc, bet, play_round(shoe, strategy, rules))
+
+        if not (i + 1) % sample_every:
+            stats.sample()
+
+    return stats
+
+
+def run_sharded(fn, rounds, seed, shards, workers, *args):
+    """
+    splits `rounds` into `shards` shards, each on its own stream spawned from
+    `seed`, and plays them on a process pool as `fn(stream, size, *args)`.
+
+    :returns: iterator over the shard results, in shard order
+    """
+
+    streams = np.random.SeedSequence(seed).spawn(shards)
+    sizes = [rounds // shards + (i < rounds % shards) for i in range(shards)]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(fn, streams, sizes, *([arg] * shards for arg in args))
+
+
+def simulate(
+    rounds,
+    seed=0,
+    rules=DEFAULT_RULES,
+    shards=DEFAULT_SHARDS,
+    workers=None,
+    penetration=DEFAULT_PENETRATION,
+    spread=DEFAULT_SPREAD,
+    sample_every=SAMPLE_EVERY,
+):
+    """
+    shards `rounds` across a process pool and merges the results.
+
+    the shard count, not the worker count, fixes the streams, so the same seed
+    and shards always give the same statistics.
+    """
+
+    chart = load_chart(rules)
+
+    logger.info(f"simulating {rounds} rounds in {shards} shards (seed {seed}).")
+
+    stats = SimStats()
+
+    for result in run_sharded(
+        run_shard, rounds, seed, shards, workers, rules, chart, penetration, spread, sample_every
+    ):
+        stats.merge(result)
+
+    return stats
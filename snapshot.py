@@ -0,0 +1,252 @@
+"""
+snapshot.py - session snapshot and restore
+
+serializes a complete session (counters, simulated shoe, funds, history, the
+session token, the table phase and the ledger's shoe number) into one compact,
+versioned binary file, and loads it back with a single pipelined transaction.
+
+file layout (little endian)
+===========================
+
+1. header: magic, version, status, rank count, run, left, funds, buyin, decks,
+   shuffles, splits, shoe length, history length, session token, ledger shoe
+   number, table phase (version 1 files end after the session token)
+1. remaining count of each rank, one int32 per rank int
+1. simulated shoe, one byte per card (its rank int), head first
+1. history, one byte per card, head first
+
+every section sits at a fixed offset from the header, so the file can be
+memory-mapped and read in place.
+"""
+
+import mmap
+import os
+import struct
+
+from loguru import logger
+
+from phases import KEY as PHASE_KEY
+from phases import UNINIT
+from rain import (
+    CHANNEL,
+    RANK_INDEX,
+    RANK_NAMES,
+    SHOE_KEYS,
+    VALUE_KEYS,
+    Command,
+    FrenchDeck,
+    Status,
+    card_value,
+    emit,
+    flush_shoe,
+    generate_session_token,
+)
+
+#
+#   Constants
+#
+
+MAGIC = b"RAIN"
+VERSION = 2
+
+HEADERS = {
+    1: struct.Struct("<4sHBBiiqqiiiII36s"),
+    2: struct.Struct("<4sHBBiiqqiiiII36si24s"),
+}
+HEADER = HEADERS[VERSION]
+COUNTS = struct.Struct(f"<{len(RANK_NAMES)}i")
+
+SCALARS = ["run", "left", "funds", "buyin", "decks", "shuffles", "splits"]
+
+
+def _encode(ranks):
+    return bytes(RANK_INDEX[rank] for rank in ranks)
+
+
+def _decode(data):
+    return [RANK_NAMES[i] for i in data]
+
+
+def save_session(s, path):
+    """
+    writes the session in `s` to `path`.
+
+    :returns: number of bytes written
+    """
+
+    pipe = s.pipeline(transaction=True)
+    pipe.mget(SHOE_KEYS)
+    pipe.mget(SCALARS)
+    pipe.get("sys:status")
+    pipe.get("sys:token")
+    pipe.get("ledger:shoe")
+    pipe.get(PHASE_KEY)
+    pipe.lrange("sim:shoe", 0, -1)
+    pipe.lrange("history", 0, -1)
+    counts, scalars, status, token, ledger_shoe, phase, shoe, history = pipe.execute()
+
+    run, left, funds, buyin, decks, shuffles, splits = (int(v or 0) for v in scalars)
+
+    try:
+        status = Status[(status or "").split(".")[-1]]
+    except KeyError:
+        status = Status.NONE
+
+    data = b"".join(
+        [
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                status.value,
+                len(RANK_NAMES),
+                run,
+                left,
+                funds,
+                buyin,
+                decks,
+                shuffles,
+                splits,
+                len(shoe),
+                len(history),
+                (token or "").encode(),
+                int(ledger_shoe or 0),
+                (phase or UNINIT).encode(),
+            ),
+            COUNTS.pack(*(int(c or 0) for c in counts)),
+            _encode(shoe),
+            _encode(history),
+        ]
+    )
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+    logger.success(f"saved session to {path} ({len(data)} bytes).")
+
+    return len(data)
+
+
+def read_snapshot(path):
+    """
+    memory-maps a snapshot file and decodes it.
+
+    :returns: dict of the session fields, or None if the file is not a valid snapshot
+    """
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        magic, version = struct.unpack_from("<4sH", m, 0) if len(m) >= 6 else (None, None)
+        header = HEADERS.get(version)
+
+        if magic != MAGIC or header is None:
+            logger.error(f"{path} is not a snapshot of version {', '.join(map(str, HEADERS))}.")
+            return None
+
+        if len(m) < header.size + COUNTS.size:
+            logger.error(f"{path} is too short to be a snapshot.")
+            return None
+
+        fields = header.unpack_from(m, 0)
+        status, nranks = fields[2:4]
+        scalars = fields[4:11]
+        nshoe, nhistory, token = fields[11:14]
+        ledger_shoe, phase = fields[14:] if version >= 2 else (None, b"")
+
+        if nranks != len(RANK_NAMES):
+            logger.error(f"{path} has {nranks} ranks, not {len(RANK_NAMES)}.")
+            return None
+
+        offset = header.size
+        counts = COUNTS.unpack_from(m, offset)
+        offset += COUNTS.size
+
+        shoe = _decode(m[offset:offset + nshoe])
+        offset += nshoe
+        history = _decode(m[offset:offset + nhistory])
+
+    snapshot = dict(zip(SCALARS, scalars))
+    snapshot.update(
+        status=Status(status),
+        token=token.rstrip(b"\0").decode(),
+        ledger_shoe=ledger_shoe,
+        phase=phase.rstrip(b"\0").decode() or None,
+        counts=list(counts),
+        shoe=shoe,
+        history=history,
+    )
+
+    return snapshot
+
+
+def restore_session(s, path):
+    """
+    replaces the session in `s` with the one saved at `path`, in one transaction.
+    the bet ledger is kept, and so is the bankroll it has been booked against:
+    `funds`, `buyin` and the ledger's shoe number are only taken from the
+    snapshot if they are not set. the table phase is restored and announced,
+    and a `shoe` event carrying the restored count restarts the shoe for
+    stream consumers.
+    """
+
+    snapshot = read_snapshot(path)
+
+    if snapshot is None:
+        return False
+
+    deck = FrenchDeck()
+
+    pipe = s.pipeline(transaction=True)
+
+    flush_shoe(s, pipe)
+
+    pipe.setnx("funds", snapshot["funds"])
+    pipe.setnx("buyin", snapshot["buyin"])
+
+    if snapshot["ledger_shoe"] is not None:
+        pipe.setnx("ledger:shoe", snapshot["ledger_shoe"])
+
+    pipe.mset(
+        dict(
+            {k: snapshot[k] for k in SCALARS if k not in ("funds", "buyin")},
+            **dict(zip(SHOE_KEYS, snapshot["counts"])),
+            **{key: card_value(name) for key, name in zip(VALUE_KEYS, RANK_NAMES)},
+        )
+    )
+    pipe.rpush("sys:ranks", *reversed(deck.ranks))
+    pipe.rpush("sys:suits", *reversed(deck.suits))
+
+    if snapshot["shoe"]:
+        pipe.rpush("sim:shoe", *snapshot["shoe"])
+
+    if snapshot["history"]:
+        pipe.rpush("history", *snapshot["history"])
+
+    pipe.set("sys:status", "Status." + snapshot["status"].name)
+
+    if snapshot["token"]:
+        pipe.set("sys:token", snapshot["token"])
+
+    emit(
+        pipe,
+        "shoe",
+        cards=52 * snapshot["decks"],
+        decks=snapshot["decks"],
+        left=snapshot["left"],
+        run=snapshot["run"],
+    )
+
+    if snapshot["phase"]:
+        pipe.set(PHASE_KEY, snapshot["phase"])
+        emit(pipe, "phase", phase=snapshot["phase"])
+        pipe.publish(CHANNEL, f"{Command.PHASE} {snapshot['phase']}")
+
+    pipe.publish(CHANNEL, "Status." + snapshot["status"].name)
+    pipe.execute()
+
+    if not snapshot["token"]:
+        generate_session_token(s)
+
+    logger.success(f"restored session from {path}.")
+
+    return True
@@ -0,0 +1,318 @@
+"""
+stats.py - incremental statistics engine (Command.STATS)
+
+a `stats` consumer group worker that folds every event on the event stream into
+running aggregates in O(1) per event:
+
+* whole-shoe and whole-session card aggregates
+* rolling windows over the last cards and the last hands
+* true count dwell time, in seconds and in cards, per true count bucket
+* hands played and win/loss/push per true count bucket
+* welford mean and variance of hand results, overall and per bucket
+
+after each batch the engine state, including the id of the last event applied,
+is written to `stats:state`, so `rainman stats` reads the aggregates instantly
+and a restarted worker skips events it has already counted.
+"""
+
+import json
+from collections import deque
+
+from loguru import logger
+
+from accumulators import TC_MAX, TC_MIN, Accumulator, tc_bucket
+from events import Consumer, stream_id
+from rain import CHANNEL, TAGS, Command, parse_rank
+
+#
+#   Constants
+#
+
+STATE_KEY = "stats:state"
+
+CARD_WINDOW = 52
+HAND_WINDOW = 100
+
+BUCKETS = range(TC_MIN, TC_MAX + 1)
+
+
+class StatsEngine:
+    """
+    running aggregates over the card and betting event stream.
+    """
+
+    def __init__(self):
+        self.last_id = "0-0"
+        self.last_ts = None
+
+        # session
+        self.shoes = 0
+        self.session_cards = 0
+        self.net = Accumulator()
+
+        # shoe
+        self.total = 0
+        self.left = 0
+        self.run = 0
+        self.shoe_cards = 0
+        self.shoe_high = 0
+        self.shoe_low = 0
+        self.tc_low = 0.0
+        self.tc_high = 0.0
+
+        # rolling windows
+        self.card_window = deque(maxlen=CARD_WINDOW)
+        self.window_run = 0
+        self.hand_window = deque(maxlen=HAND_WINDOW)
+        self.window_net = 0
+        self.window_wins = 0
+
+        # per true count bucket
+        self.dwell_ms = {b: 0 for b in BUCKETS}
+        self.dwell_cards = {b: 0 for b in BUCKETS}
+        self.hands = {b: Accumulator() for b in BUCKETS}
+        self.wins = {b: 0 for b in BUCKETS}
+        self.losses = {b: 0 for b in BUCKETS}
+        self.pushes = {b: 0 for b in BUCKETS}
+
+    @property
+    def tc(self):
+        return self.run / (self.left / 52) if self.left > 0 else 0.0
+
+    #
+    #   Event handling
+    #
+
+    def apply(self, i, fields):
+        """
+        folds one stream event into the aggregates; events at or before the
+        last applied id are ignored.
+        """
+
+        if not fields or stream_id(i) <= stream_id(self.last_id):
+            return
+
+        ts = stream_id(i)[0]
+
+        if self.last_ts is not None and self.total:
+            self.dwell_ms[tc_bucket(self.tc)] += ts - self.last_ts
+
+        self.last_ts = ts
+        self.last_id = i
+
+        kind = fields.get("kind")
+
+        if kind == "shoe":
+            self.new_shoe(
+                int(fields["cards"]),
+                int(fields.get("left", fields["cards"])),
+                int(fields.get("run", 0)),
+            )
+
+        elif kind in ("remove", "replace"):
+            rank = parse_rank(fields["rank"])
+            direction = 1 if kind == "remove" else -1
+
+            for _ in range(int(fields.get("n", 1))):
+                self.card(rank, direction)
+
+        elif kind == "settle":
+            self.hand(int(fields["tc"]), int(fields["bet"]), int(fields["net"]))
+
+    def new_shoe(self, cards, left=None, run=0):
+        """
+        a fresh shoe of `cards`, or one already dealt down to `left` cards at
+        running count `run` (a restored session).
+        """
+
+        self.shoes += 1
+        self.total = cards
+        self.left = cards if left is None else left
+        self.run = run
+        self.shoe_cards = self.shoe_high = self.shoe_low = 0
+        self.tc_low = self.tc_high = 0.0
+        self.card_window.clear()
+        self.window_run = 0
+
+    def card(self, rank, direction):
+        """
+        a card (rank int) leaving (direction 1) or returning to (direction -1)
+        the shoe.
+        """
+
+        tag = TAGS[rank]
+        value = tag * direction
+
+        self.left -= direction
+        self.run += value
+        self.shoe_cards += direction
+        self.session_cards += direction
+
+        if tag > 0:
+            self.shoe_low += direction
+        elif tag < 0:
+            self.shoe_high += direction
+
+        if direction > 0:
+            # the card dwelt at the count before it left the shoe
+            bucket = tc_bucket((self.run - value) / ((self.left + 1) / 52))
+            self.dwell_cards[bucket] += 1
+
+            if len(self.card_window) == self.card_window.maxlen:
+                self.window_run -= self.card_window[0][0]
+            self.card_window.append((value, bucket))
+            self.window_run += value
+
+        else:
+            # a replacement corrects the latest card of the same value, if it
+            # is still in the (bounded) window
+            for k in range(len(self.card_window) - 1, -1, -1):
+                old, bucket = self.card_window[k]
+
+                if old == -value:
+                    del self.card_window[k]
+                    self.window_run -= old
+                    self.dwell_cards[bucket] -= 1
+                    break
+
+        tc = self.tc
+        self.tc_low = min(self.tc_low, tc)
+        self.tc_high = max(self.tc_high, tc)
+
+    def hand(self, tc, bet, net):
+        """
+        a settled hand: `bet` and `net` in cents, `tc` the bucket at bet time.
+        """
+
+        bucket = tc_bucket(tc)
+
+        self.net.add(net)
+        self.hands[bucket].add(net / bet if bet else 0.0)
+
+        if net > 0:
+            self.wins[bucket] += 1
+        elif net < 0:
+            self.losses[bucket] += 1
+        else:
+            self.pushes[bucket] += 1
+
+        if len(self.hand_window) == self.hand_window.maxlen:
+            old = self.hand_window[0]
+            self.window_net -= old
+            self.window_wins -= old > 0
+        self.hand_window.append(net)
+        self.window_net += net
+        self.window_wins += net > 0
+
+    #
+    #   Persistence
+    #
+
+    def dumps(self):
+        state = {
+            k: v
+            for k, v in vars(self).items()
+            if not isinstance(v, (Accumulator, deque, dict))
+        }
+        state.update(
+            net=self.net.as_list(),
+            card_window=list(self.card_window),
+            hand_window=list(self.hand_window),
+            dwell_ms=self.dwell_ms,
+            dwell_cards=self.dwell_cards,
+            hands={b: a.as_list() for b, a in self.hands.items()},
+            wins=self.wins,
+            losses=self.losses,
+            pushes=self.pushes,
+        )
+
+        return json.dumps(state)
+
+    @classmethod
+    def loads(cls, data):
+        engine = cls()
+
+        if not data:
+            return engine
+
+        state = json.loads(data)
+
+        for k in ("dwell_ms", "dwell_cards", "wins", "losses", "pushes"):
+            state[k] = {int(b): v for b, v in state[k].items()}
+
+        state["hands"] = {int(b): Accumulator(*a) for b, a in state["hands"].items()}
+        state["net"] = Accumulator(*state["net"])
+        state["card_window"] = deque(map(tuple, state["card_window"]), maxlen=CARD_WINDOW)
+        state["hand_window"] = deque(state["hand_window"], maxlen=HAND_WINDOW)
+
+        vars(engine).update(state)
+
+        return engine
+
+    #
+    #   Reporting
+    #
+
+    def report(self):
+        logger.info(f"shoes: {self.shoes}, cards seen: {self.session_cards}")
+        logger.info(
+            f"shoe: {self.shoe_cards}/{self.total} cards, "
+            f"{self.shoe_low} low / {self.shoe_high} high, "
+            f"TC {self.tc:+.2f} (range {self.tc_low:+.2f} to {self.tc_high:+.2f})"
+        )
+        logger.info(f"last {len(self.card_window)} cards: run {self.window_run:+d}")
+
+        if self.hand_window:
+            logger.info(
+                f"last {len(self.hand_window)} hands: "
+                f"${self.window_net / 100:+.2f}, "
+                f"{100 * self.window_wins / len(self.hand_window):.1f}% won"
+            )
+
+        if self.net.n:
+            logger.success(
+                f"hands: {self.net.n}, "
+                f"${self.net.mean / 100:+.2f} per hand, "
+                f"sd ${self.net.variance ** 0.5 / 100:.2f}"
+            )
+
+        for b in BUCKETS:
+            hands = self.hands[b]
+
+            if not (hands.n or self.dwell_cards[b] or self.dwell_ms[b]):
+                continue
+
+            print(
+                f"TC {b:+3d}: {self.dwell_ms[b] / 1000:9.1f}s "
+                f"{self.dwell_cards[b]:6d} cards "
+                f"{hands.n:6d} hands "
+                f"{self.wins[b]:5d}W {self.losses[b]:5d}L {self.pushes[b]:5d}P "
+                f"{hands.mean:+.3f} ev/bet"
+            )
+
+
+def get_stats(s):
+    """
+    reads the aggregates last written by the stats worker.
+    """
+
+    engine = StatsEngine.loads(s.get(STATE_KEY))
+    s.publish(CHANNEL, f"{Command.STATS} {engine.session_cards}")
+    return engine
+
+
+def run_worker(s, name=None):
+    """
+    runs the stats consumer group worker forever.
+    """
+
+    engine = StatsEngine.loads(s.get(STATE_KEY))
+
+    def handler(events):
+        for i, fields in events:
+            engine.apply(i, fields)
+
+        s.set(STATE_KEY, engine.dumps())
+
+    logger.info(f"stats worker starting after event {engine.last_id}.")
+    Consumer(s, "stats", name).run(handler)
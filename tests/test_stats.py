@@ -0,0 +1,88 @@
+from stats import StatsEngine
+
+
+def replay(events):
+    """
+    applies `events` as (kind, fields) in order, one millisecond apart.
+    """
+
+    engine = StatsEngine()
+
+    for ms, (kind, fields) in enumerate(events, 1):
+        engine.apply(f"{ms}-0", dict(fields, kind=kind))
+
+    return engine
+
+
+def test_removes_and_replaces():
+    engine = replay(
+        [
+            ("shoe", {"cards": 52, "decks": 1}),
+            ("remove", {"rank": "A"}),
+            ("remove", {"rank": "5"}),
+            ("remove", {"rank": "K"}),
+            ("replace", {"rank": "5"}),
+            ("replace", {"rank": "2"}),
+            ("remove", {"rank": "3", "n": 2}),
+        ]
+    )
+
+    assert engine.shoe_low == 1
+    assert engine.shoe_high == 2
+    assert engine.shoe_cards == 3
+    assert engine.left == 49
+    assert engine.run == -1
+    # the 2 was never removed, so its replacement has no card to correct
+    assert engine.window_run == 0
+    assert sum(engine.dwell_cards.values()) == 4
+
+
+def test_replace_of_high_card():
+    engine = replay(
+        [
+            ("shoe", {"cards": 52, "decks": 1}),
+            ("remove", {"rank": "K"}),
+            ("remove", {"rank": "Q"}),
+            ("replace", {"rank": "K"}),
+        ]
+    )
+
+    assert (engine.shoe_low, engine.shoe_high) == (0, 1)
+    assert engine.run == -1
+    assert list(engine.card_window) == [(-1, 0)]
+
+
+def test_old_events_are_skipped():
+    engine = replay([("shoe", {"cards": 52, "decks": 1}), ("remove", {"rank": "2"})])
+    engine.apply("1-0", {"kind": "remove", "rank": "3"})
+
+    assert engine.shoe_cards == 1
+
+
+def test_state_round_trip():
+    engine = replay(
+        [
+            ("shoe", {"cards": 52, "decks": 1}),
+            ("remove", {"rank": "6"}),
+            ("settle", {"tc": 1, "bet": 1000, "net": 1000}),
+        ]
+    )
+
+    restored = StatsEngine.loads(engine.dumps())
+
+    assert restored.dumps() == engine.dumps()
+    assert restored.wins[1] == 1
+
+
+def test_restored_shoe():
+    engine = replay(
+        [
+            ("shoe", {"cards": 52, "decks": 1}),
+            ("remove", {"rank": "K"}),
+            ("shoe", {"cards": 312, "decks": 6, "left": 200, "run": 4}),
+            ("remove", {"rank": "2"}),
+        ]
+    )
+
+    assert (engine.total, engine.left, engine.run) == (312, 199, 5)
+    assert engine.shoes == 2
@@ -0,0 +1,302 @@
+"""
+tui.py - full-screen live mode
+
+a curses dashboard for `rainman live`. the shoe is read from redis once, then kept
+in a local view that is updated from the replies of each batch of cards, and only
+the screen cells whose text changed are redrawn. side bet evs are kept up to date
+incrementally from the same batches and shown next to the rank counts, so the
+whole dashboard fits a standard 80x24 terminal; on smaller terminals it is
+clipped, and it is redrawn whenever the terminal is resized. the table phase is
+followed from the event stream in a background thread, which wakes the prompt
+through a pipe so a phase change shows up at once, keeping any half-typed line.
+
+each input line is one batch: any number of ranks to remove and `-rank` to put
+back, sent to redis in a single round trip. `D` draws from the simulated shoe,
+`RR` starts a new shoe and `Z` exits.
+"""
+
+import curses
+import os
+import select
+import sys
+import threading
+
+from loguru import logger
+
+from phases import follow, get_phase
+from rain import RANK_NAMES, SHOE_KEYS, init_session, parse_rank, update_cards
+from sidebets import SideBets
+
+#
+#   Constants
+#
+
+PROMPT = "Card/Command [Z to Exit]: "
+
+HEADER_ROWS = 6
+SIDEBET_COL = 24
+
+STATUS_ROW = HEADER_ROWS + len(RANK_NAMES) + 1
+PROMPT_ROW = STATUS_ROW + 1
+
+# how often the prompt checks for a terminal resize while waiting for input
+RESIZE_POLL = 0.25  # s
+
+
+def parse_line(line):
+    """
+    splits an input line into card operations and commands. this is where
+    rank strings become rank ints.
+
+    :returns: (list of (rank int, n), list of commands, list of unknown tokens)
+    """
+
+    ops, commands, unknown = [], [], []
+
+    for token in line.upper().split():
+        if token in ("D", "RR", "Z"):
+            commands.append(token)
+            continue
+
+        n = -1 if token[0] == "-" and len(token) > 1 else 1
+        rank = parse_rank(token[1:] if n < 0 else token)
+
+        if rank is None:
+            unknown.append(token)
+        else:
+            ops.append((rank, n))
+
+    return ops, commands, unknown
+
+
+class ShoeView:
+    """
+    local cache of the shoe, kept in step with redis from command replies.
+    """
+
+    def __init__(self, s, table):
+        self.s = s
+        self.table = table
+        self.reload()
+
+    def reload(self):
+        values = [int(v or 0) for v in self.s.mget(SHOE_KEYS + ["left", "run", "funds", "decks"])]
+
+        self.counts = values[:len(RANK_NAMES)]
+        self.left, self.run, self.funds, self.decks = values[len(RANK_NAMES):]
+        self.sidebets = SideBets(self.counts)
+        self.phase = get_phase(self.s)
+
+    def apply(self, ops):
+        counts, left, run = update_cards(self.s, ops)
+
+        if not counts:
+            return
+
+        for rank, count in counts.items():
+            self.counts[rank] = count
+
+        for rank, n in ops:
+            self.sidebets.update(rank, n)
+
+        self.left, self.run = left, run
+
+    def draw_card(self):
+        card = self.s.rpop("sim:shoe")
+
+        if card is not None:
+            self.apply([(parse_rank(card), 1)])
+
+        return card
+
+    @property
+    def real(self):
+        return self.run / (self.left / 52) if self.left > 0 else 0.0
+
+    def cells(self):
+        """
+        the screen contents as {row: text}.
+        """
+
+        left = self.left or 1
+        real = self.real
+        edge = self.table.edge(real, 1 - self.left / (52 * (self.decks or 1)))
+
+        rows = {
+            0: f"DECKS: {self.left / 52:.2f}",
+            1: f"CARDS: {self.left}",
+            2: f" REAL: {real:.3f} ({100 * edge:+.2f}% edge)",
+            3: f"  RUN: {self.run}",
+            4: f"FUNDS: ${self.funds / 100:.2f}",
+            5: f"PHASE: {self.phase}",
+        }
+
+        sidebets = [f"{bet:>13s}: {100 * ev:+.2f}%" for bet, ev in self.sidebets.evs().items()]
+
+        for rank, (name, count) in enumerate(zip(RANK_NAMES, self.counts)):
+            text = f"{name:3s}: {count} ({100 * count / left:.2f}%)"
+
+            if rank < len(sidebets):
+                text = text.ljust(SIDEBET_COL) + sidebets[rank]
+
+            rows[HEADER_ROWS + rank] = text
+
+        return rows
+
+
+class Screen:
+    """
+    writes only the rows that differ from what is already on screen, clipped
+    to the terminal size.
+    """
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.stdscr.nodelay(True)
+        self.drawn = {}
+        self.line = ""
+        self.resize()
+
+    def resize(self):
+        self.height, self.width = self.stdscr.getmaxyx()
+
+        # on a short terminal the prompt takes the last row and the status the
+        # one above it, covering whatever does not fit
+        self.prompt_row = min(PROMPT_ROW, self.height - 1)
+        self.status_row = min(STATUS_ROW, max(self.prompt_row - 1, 0))
+
+    def _put(self, row, text):
+        if row >= self.height:
+            return
+
+        self.stdscr.move(row, 0)
+        self.stdscr.clrtoeol()
+
+        # the bottom right cell cannot be written without an error
+        self.stdscr.addstr(row, 0, text[: max(self.width - 1, 0)])
+
+    def draw(self, rows):
+        for row, text in rows.items():
+            if row in (self.status_row, self.prompt_row):
+                continue
+
+            if self.drawn.get(row) != text:
+                self._put(row, text)
+                self.drawn[row] = text
+
+    def status(self, text):
+        self._put(self.status_row, text)
+        self.drawn[self.status_row] = text
+
+    def invalidate(self):
+        self.stdscr.clear()
+        self.drawn = {}
+
+    def _keys(self):
+        """
+        yields the keys already typed, without blocking.
+        """
+
+        while True:
+            try:
+                yield self.stdscr.get_wch()
+            except curses.error:
+                return
+
+    def prompt(self, wake=None):
+        """
+        reads one line of input. a partly typed line is kept when this returns
+        early, and shown again by the next call.
+
+        :param wake: fd of a pipe; when it becomes readable, returns so the
+            screen can be redrawn
+        :returns: the line, or None if the terminal was resized or `wake` fired
+            meanwhile
+        """
+
+        fds = [sys.stdin.fileno()] + ([wake] if wake is not None else [])
+
+        while True:
+            for key in self._keys():
+                if key == curses.KEY_RESIZE:
+                    curses.update_lines_cols()
+                    self.resize()
+                    self.invalidate()
+                    return None
+
+                if key in ("\n", "\r", curses.KEY_ENTER):
+                    line, self.line = self.line, ""
+                    return line
+
+                if key in ("\b", "\x7f", curses.KEY_BACKSPACE):
+                    self.line = self.line[:-1]
+                elif isinstance(key, str) and key.isprintable():
+                    self.line += key
+
+            self._put(self.prompt_row, PROMPT + self.line)
+            self.stdscr.refresh()
+
+            ready, _, _ = select.select(fds, [], [], RESIZE_POLL)
+
+            if wake is not None and wake in ready:
+                os.read(wake, 4096)
+                return None
+
+
+def _follow_phase(s, view, wake):
+    """
+    keeps `view.phase` current, writing to the `wake` pipe on every change.
+    """
+
+    for phase in follow(s):
+        view.phase = phase
+        os.write(wake, b"\0")
+
+
+def _main(stdscr, s, decks, table):
+    view = ShoeView(s, table)
+    screen = Screen(stdscr)
+
+    wake, notify = os.pipe()
+    threading.Thread(target=_follow_phase, args=(s, view, notify), daemon=True).start()
+
+    while True:
+        screen.draw(view.cells())
+
+        line = screen.prompt(wake)
+
+        if line is None:
+            continue
+
+        ops, commands, unknown = parse_line(line)
+
+        if ops:
+            view.apply(ops)
+
+        screen.status(" ".join(f"{k} not a command" for k in unknown))
+
+        if "Z" in commands:
+            return
+
+        if "RR" in commands:
+            init_session(s, decks=decks)
+            view.reload()
+            screen.invalidate()
+
+        for _ in range(commands.count("D")):
+            card = view.draw_card()
+            screen.status(f"card: {card}" if card else "simulated shoe is empty")
+
+
+def live(s, decks, table):
+    """
+    runs the live dashboard until `Z` is entered, showing the edge from `table`
+    (see `edges.load_table`).
+    """
+
+    logger.disable("rain")
+
+    try:
+        curses.wrapper(_main, s, decks, table)
+    finally:
+        logger.enable("rain")
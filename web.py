@@ -0,0 +1,304 @@
+"""
+web.py - the rainman web front end
+
+a single asyncio process that subscribes once to the rainman channel and pushes
+only the fields that changed (rank counts, run, true count, funds) to every
+connected browser over a websocket. late joiners get one snapshot, then deltas.
+each viewer has its own bounded queue and writer task, so a slow socket only
+holds up itself; one that falls a whole queue behind is dropped.
+the table phase is part of the state; every transition publishes on the channel,
+so viewers see it change as soon as it happens.
+"""
+
+import asyncio
+import json
+
+import redis.asyncio as aioredis
+from aiohttp import web
+from redis.exceptions import ConnectionError, TimeoutError
+from loguru import logger
+
+from phases import KEY as PHASE_KEY
+from phases import normalize_phase
+from rain import CHANNEL, RANK_NAMES, SHOE_KEYS, _default_config
+
+#
+#   Constants
+#
+
+# every key the front end shows, read back in a single MGET
+STATE_KEYS = SHOE_KEYS + ["run", "left", "funds", PHASE_KEY]
+
+# minimum seconds between two refreshes; bursts of card events collapse into one
+REFRESH_INTERVAL = 0.05
+
+# seconds between attempts to get the subscription back, doubling up to the max
+RETRY_MIN = 0.5
+RETRY_MAX = 30
+
+# messages waiting for one viewer before it is dropped as too slow
+CLIENT_QUEUE = 64
+
+INDEX = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>rainman</title></head>
+<body>
+<pre id="state"></pre>
+<script>
+const state = {};
+const ws = new WebSocket(`ws://${location.host}/ws`);
+ws.onmessage = (event) => {
+  const msg = JSON.parse(event.data);
+  Object.assign(state, msg.state);
+  document.getElementById("state").textContent = JSON.stringify(state, null, 2);
+};
+</script>
+</body>
+</html>
+"""
+
+
+def parse_state(values):
+    """
+    turns the raw MGET reply for STATE_KEYS into the state shown to viewers.
+    """
+
+    counts = values[:len(RANK_NAMES)]
+    run, left, funds = (int(v or 0) for v in values[len(RANK_NAMES):-1])
+
+    state = {name: int(c or 0) for name, c in zip(RANK_NAMES, counts)}
+
+    state["run"] = run
+    state["left"] = left
+    state["real"] = round(run / (left / 52), 3) if left else 0.0
+    state["funds"] = funds / 100
+    state["phase"] = normalize_phase(values[-1])
+
+    return state
+
+
+def state_delta(old, new):
+    """
+    returns only the fields of `new` that differ from `old`.
+    """
+
+    return {k: v for k, v in new.items() if old.get(k) != v}
+
+
+class Broadcaster:
+    """
+    owns the one redis subscription and fans state deltas out to the viewers
+    """
+
+    def __init__(self, s, interval=REFRESH_INTERVAL):
+        self.s = s
+        self.interval = interval
+        self.state = {}
+        self.clients = {}  # ws -> (queue, writer task)
+        self._dirty = asyncio.Event()
+        self._tasks = []
+        self._closing = set()
+
+    async def start(self):
+        self.state = parse_state(await self.s.mget(STATE_KEYS))
+        self._tasks = [
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._refresh()),
+        ]
+        logger.info(f"broadcaster subscribed to '{CHANNEL}'.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        for ws in list(self.clients):
+            self.leave(ws)
+            await ws.close()
+
+        await asyncio.gather(*self._closing, return_exceptions=True)
+
+    async def _listen(self):
+        """
+        any message on the channel only marks the state dirty; the refresh
+        loop decides when to actually hit redis.
+
+        if the connection drops, the subscription is retried with backoff, and
+        once it is back the viewers get a full snapshot, since messages sent in
+        between are lost.
+        """
+
+        delay = RETRY_MIN
+        lost = False
+
+        while True:
+            pubsub = self.s.pubsub()
+
+            try:
+                await pubsub.subscribe(CHANNEL)
+
+                if lost:
+                    await self.resync()
+                    logger.success(f"resubscribed to '{CHANNEL}'.")
+                    delay, lost = RETRY_MIN, False
+
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._dirty.set()
+
+            except (ConnectionError, TimeoutError, OSError) as e:
+                logger.warning(f"lost '{CHANNEL}' subscription ({e}), retrying in {delay:.1f}s.")
+                lost = True
+
+            finally:
+                try:
+                    await pubsub.aclose()
+                except (ConnectionError, TimeoutError, OSError):
+                    pass
+
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, RETRY_MAX)
+
+    async def _refresh(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+
+            try:
+                new = parse_state(await self.s.mget(STATE_KEYS))
+            except (ConnectionError, TimeoutError, OSError) as e:
+                # the listener resyncs everyone once redis is back
+                logger.warning(f"could not refresh state ({e}).")
+                continue
+
+            delta = state_delta(self.state, new)
+
+            if delta:
+                self.state.update(delta)
+                self.broadcast({"type": "delta", "state": delta})
+
+            await asyncio.sleep(self.interval)
+
+    async def resync(self):
+        """
+        re-reads the whole state and sends it to every viewer as a snapshot.
+        """
+
+        self.state = parse_state(await self.s.mget(STATE_KEYS))
+        self.broadcast({"type": "snapshot", "state": self.state})
+
+    def broadcast(self, payload):
+        """
+        queues `payload` for every viewer without waiting on any socket.
+        """
+
+        if not self.clients:
+            return
+
+        data = json.dumps(payload)
+
+        for ws, (queue, _) in list(self.clients.items()):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                logger.warning(f"dropping viewer {CLIENT_QUEUE} messages behind.")
+                self.leave(ws)
+                self._close(ws)
+
+    async def _write(self, ws, queue):
+        while True:
+            data = await queue.get()
+
+            try:
+                await ws.send_str(data)
+            except ConnectionError as e:
+                logger.warning(f"dropping viewer: {e}")
+                self.clients.pop(ws, None)
+                return
+
+    def _close(self, ws):
+        task = asyncio.create_task(ws.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def join(self, ws):
+        """
+        registers a viewer. its snapshot is queued in the same step, so every
+        delta sent after it is one the snapshot does not already include.
+        """
+
+        queue = asyncio.Queue(CLIENT_QUEUE)
+        queue.put_nowait(json.dumps({"type": "snapshot", "state": self.state}))
+
+        self.clients[ws] = queue, asyncio.create_task(self._write(ws, queue))
+        logger.info(f"viewer joined, {len(self.clients)} connected.")
+
+    def leave(self, ws):
+        client = self.clients.pop(ws, None)
+
+        if client is None:
+            return
+
+        client[1].cancel()
+        logger.info(f"viewer left, {len(self.clients)} connected.")
+
+
+#
+#   HTTP handlers
+#
+
+
+async def index(request):
+    return web.Response(text=INDEX, content_type="text/html")
+
+
+async def websocket(request):
+    broadcaster = request.app["broadcaster"]
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    broadcaster.join(ws)
+
+    try:
+        # viewers are read-only; drain anything they send until they go away
+        async for _ in ws:
+            pass
+    finally:
+        broadcaster.leave(ws)
+
+    return ws
+
+
+def create_app(host=None, port=None, db=None):
+    """
+    builds the aiohttp application serving the front end for one redis db.
+    """
+
+    host = host or _default_config["red_host"]
+    port = port or _default_config["red_port"]
+    db = db or _default_config["red_db"]
+
+    async def on_startup(app):
+        app["redis"] = aioredis.StrictRedis(
+            host=host, port=port, db=db, decode_responses=True
+        )
+        app["broadcaster"] = Broadcaster(app["redis"])
+        await app["broadcaster"].start()
+
+    async def on_cleanup(app):
+        await app["broadcaster"].stop()
+        await app["redis"].aclose()
+
+    app = web.Application()
+    app.router.add_get("/", index)
+    app.router.add_get("/ws", websocket)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+
+    return app
+
+
+def serve(host="0.0.0.0", port=8080, db=None):
+    logger.info(f"serving web front end on http://{host}:{port}")
+    web.run_app(create_app(db=db), host=host, port=port, print=None)